@@ -25,6 +25,10 @@ class Session:
         self.__chord_style = None
         self.__texture_style = None
 
+    def close(self):
+        if self.__core is not None:
+            self.__core.close()
+
     @staticmethod
     def get_log(log_dict):
         log = []
@@ -236,6 +240,7 @@ class Sessions:
             if current_time - session.last_active < EXPIRE:
                 new_sessions[session_id] = session
             else:
+                session.close()
                 for file in os.listdir('..'):
                     if session_id in file:
                         shutil.rmtree(file)
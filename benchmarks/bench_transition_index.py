@@ -0,0 +1,46 @@
+"""
+Check RootSequenceIndex against the brute-force scan and time both.
+
+    python benchmarks/bench_transition_index.py [-n PAIRS]
+
+Scores the transitions between random pairs of representative progressions
+(the fallback DP.transition_score takes when a pair is missing from
+transition_score.mdch) both ways, and exits with status 1 if any score
+differs.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chorderator.chords.ChordProgression import read_progressions
+from chorderator.chords.RootSequenceIndex import RootSequenceIndex, count_by_scan, transition_chord_sequences
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--pairs', type=int, default=200)
+    args = parser.parse_args()
+
+    templates = list(read_progressions('rep'))
+    rng = random.Random(0)
+    pairs = [(rng.choice(templates), rng.choice(templates)) for _ in range(args.pairs)]
+    sequences = [transition_chord_sequences(prev, cur) for prev, cur in pairs]
+
+    t = time.perf_counter()
+    scanned = [count_by_scan(templates, chord_sequences) for chord_sequences in sequences]
+    scan_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    index = RootSequenceIndex(templates)
+    indexed = [index.score(chord_sequences) for chord_sequences in sequences]
+    index_time = time.perf_counter() - t
+
+    mismatches = sum(a != b for a, b in zip(scanned, indexed))
+    print('{} templates, {} transitions'.format(len(templates), len(pairs)))
+    print('scan   {:8.1f} ms'.format(scan_time * 1000))
+    print('index  {:8.1f} ms (including building it)'.format(index_time * 1000))
+    print('mismatches: {}'.format(mismatches))
+    sys.exit(1 if mismatches else 0)
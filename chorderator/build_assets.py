@@ -0,0 +1,176 @@
+"""
+Build and verify the compiled asset bundles.
+
+    python -m chorderator.build_assets                 # build every family whose source exists
+    python -m chorderator.build_assets rep trans       # only these
+    python -m chorderator.build_assets --verify        # build, then check the bundles
+    python -m chorderator.build_assets --check         # only check the existing bundles
+    python -m chorderator.build_assets --force         # rebuild bundles that are up to date
+
+A bundle is up to date when it was built from the source file as it is now
+(same size and mtime as recorded at build time, or else the same SHA-1) and
+with the current schema version of its family; the package ignores other
+bundles and reads their sources. Verification reports stale bundles,
+re-hashes the bundle content against the hash recorded at build time and
+compares the runtime object read from the bundle with the one read from the
+source file. The exit status is 1 when a verification fails.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from .settings import bundle_storage
+from .utils.assets import ASSET_FAMILIES, ASSET_SCHEMAS, Bundle, bundle_staleness, compile_asset, content_sha1, \
+    open_bundle
+
+
+# ############
+# Equivalence
+# ############
+
+def _same_arrays(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return a.shape == b.shape and np.array_equal(a, b, equal_nan=a.dtype.kind == 'f')
+
+
+def _same_mapping(raw, compiled, same_value):
+    if set(raw.keys()) != set(compiled.keys()):
+        return False
+    return all(same_value(raw[key], compiled[key]) for key in raw.keys())
+
+
+def _progression_state(progression):
+    attributes = {name: value for name, value in vars(progression).items() if name not in ('_progression', 'cache')}
+    chords = [[vars(chord) for chord in bar] for bar in progression.get_chord_progression()]
+    return attributes, chords
+
+
+def _same_progressions(raw, compiled):
+    if isinstance(raw, dict):
+        return _same_mapping(raw, compiled, _same_progressions)
+    return len(raw) == len(compiled) and all(_progression_state(a) == _progression_state(b)
+                                             for a, b in zip(raw, compiled))
+
+
+def _same_phrase_data(raw, compiled):
+    for field in compiled:
+        songs = raw[field]
+        if len(songs) != len(compiled[field]):
+            return False
+        for song_idx in range(len(songs)):
+            phrases = compiled[field][song_idx]
+            if len(songs[song_idx]) != len(phrases):
+                return False
+            if not all(_same_arrays(a, b) for a, b in zip(songs[song_idx], phrases)):
+                return False
+    return True
+
+
+def _same_state_dict(raw, compiled):
+    return _same_mapping(raw, compiled, lambda a, b: _same_arrays(a.detach().cpu().numpy(), b.numpy()))
+
+
+def _same_song_index(raw, compiled):
+    return _same_mapping(raw.to_arrays(), compiled.to_arrays(), _same_arrays)
+
+
+def _same_repr(raw, compiled):
+    # small plain-Python families: exact, including int / float and tuple / list types
+    return repr(raw) == repr(compiled)
+
+
+EQUIVALENCE = {
+    'lib': lambda raw, compiled: _same_mapping(raw, compiled, _same_arrays),
+    'dict': _same_progressions,
+    'rep': _same_progressions,
+    'trans': _same_repr,
+    'concat_major': _same_repr,
+    'concat_minor': _same_repr,
+    'state_dict': _same_state_dict,
+    'phrase_data': _same_phrase_data,
+    'edge_weights': lambda raw, compiled: _same_mapping(raw, compiled, _same_arrays),
+    'song_index': _same_song_index,
+}
+
+
+# ########
+# Commands
+# ########
+
+def is_up_to_date(name):
+    bundle = open_bundle(name)
+    if bundle is None:
+        return False
+    return bundle_staleness(name, bundle) is None
+
+
+def verify(name):
+    """returns a list of problems, empty if the bundle is good"""
+    source, raw_loader, from_bundle, _ = ASSET_FAMILIES[name]
+    path = bundle_storage[name]
+    if not os.path.exists(path):
+        return ['no bundle at {}'.format(path)]
+    try:
+        bundle = Bundle(path)
+    except ValueError as e:
+        return [str(e)]
+    problems = []
+    if bundle.meta.get('schema') != ASSET_SCHEMAS[name]:
+        problems.append('schema {}, expected {}'.format(bundle.meta.get('schema'), ASSET_SCHEMAS[name]))
+    if bundle.meta.get('content_sha1') != content_sha1(bundle):
+        problems.append('content does not match the recorded hash')
+    if not os.path.exists(source):
+        problems.append('source {} not found, round trip not checked'.format(source))
+        return problems
+    staleness = bundle_staleness(name, bundle)
+    if staleness is not None:
+        problems.append('stale, ' + staleness)
+    if not EQUIVALENCE[name](raw_loader(), from_bundle(bundle)):
+        problems.append('round trip differs from {}'.format(os.path.basename(source)))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m chorderator.build_assets',
+                                     description='Build and verify the compiled asset bundles.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='asset families to process (default: all): ' + ', '.join(ASSET_FAMILIES))
+    parser.add_argument('--verify', action='store_true', help='check the bundles after building them')
+    parser.add_argument('--check', action='store_true', help='only check the existing bundles')
+    parser.add_argument('--force', action='store_true', help='rebuild bundles that are up to date')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in ASSET_FAMILIES]
+    if unknown:
+        parser.error('unknown asset families: ' + ', '.join(unknown))
+
+    failed = False
+    for name in (args.names if args.names else list(ASSET_FAMILIES)):
+        source = ASSET_FAMILIES[name][0]
+        if not args.check:
+            if not os.path.exists(source):
+                print('{:<14} skipped, {} not found'.format(name, os.path.basename(source)))
+                continue
+            if not args.force and is_up_to_date(name):
+                print('{:<14} up to date'.format(name))
+            else:
+                compile_asset(name)
+                print('{:<14} built {} ({} bytes)'.format(name, bundle_storage[name],
+                                                         os.path.getsize(bundle_storage[name])))
+        if args.check and not os.path.exists(bundle_storage[name]):
+            print('{:<14} skipped, not built'.format(name))
+            continue
+        if args.verify or args.check:
+            problems = verify(name)
+            if problems:
+                failed = True
+                print('{:<14} FAILED: {}'.format(name, '; '.join(problems)))
+            else:
+                meta = Bundle(bundle_storage[name]).meta
+                print('{:<14} ok (schema {}, content {})'.format(name, meta['schema'], meta['content_sha1'][:12]))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
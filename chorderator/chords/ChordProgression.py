@@ -8,10 +8,10 @@ from pretty_midi import PrettyMIDI, Instrument, Note
 
 from .Chord import Chord
 from ..utils.string import STATIC_DIR
-from ..utils.utils import compute_distance, compute_destination, Logging, pickle_read
+from ..utils.utils import compute_distance, compute_destination, Logging
 from ..utils.constants import *
 from ..utils.structured import str_to_root
-from ..settings import static_storage
+from ..settings import static_storage, bundle_storage
 
 
 class ChordProgression:
@@ -209,7 +209,8 @@ class ChordProgression:
 
         else:
             if lib is None:
-                lib = pickle_read('lib')
+                from ..utils.assets import load_asset
+                lib = load_asset('lib')
             try:
                 all_notes = lib[self.meta['source']]
             except:
@@ -291,10 +292,7 @@ class ChordProgression:
                 yield j
 
     def __len__(self):
-        count = 0
-        for i in self:
-            count += 1
-        return count
+        return sum(len(bar) for bar in self.get_chord_progression())
 
     def __contains__(self, item):
         if type(item) is str:
@@ -395,7 +393,12 @@ class ChordProgression:
         return str(value) if value is not None else 'None'
 
 
-def read_progressions(progression_file='progressions.pcls', span=False):
+def read_progressions(progression_file='progressions.pcls', span=False, compiled=True):
+    # a compiled progression store (see ProgressionStore.py) is read instead of the pickle when there is one
+    if compiled and not span and progression_file in bundle_storage and os.path.exists(bundle_storage[progression_file]):
+        from ..utils.assets import load_asset
+        return load_asset(progression_file)
+
     class RenameUnpickler(pickle.Unpickler):
         def find_class(self, module, name):
             renamed_module = module
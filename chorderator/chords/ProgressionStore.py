@@ -0,0 +1,259 @@
+"""
+Columnar storage for progression libraries (dict.pcls, representatives.pcls).
+
+Instead of a pickled graph of ChordProgression and Chord objects, a library
+is kept as a few flat arrays inside an asset bundle (see utils/assets.py):
+
+    bar_offsets    progression i owns bars bar_offsets[i]:bar_offsets[i + 1]
+    chord_offsets  bar j owns chords chord_offsets[j]:chord_offsets[j + 1]
+    group_offsets  only for dict libraries, group k owns progressions
+                   group_offsets[k]:group_offsets[k + 1]
+
+Every attribute of a progression (meta, progression_class, appeared_time,
+...) and of a chord (root, type, ...) is a categorical column: an integer
+code per row into a small vocabulary of repr()-encoded values, -1 where the
+object has no such attribute. Numpy scalars are stored as plain Python
+numbers.
+
+ProgressionStore and ProgressionGroups are read-only views over a bundle;
+ChordProgression objects are built the first time they are accessed.
+"""
+import ast
+import copy
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from .Chord import Chord
+from .ChordProgression import ChordProgression
+from ..utils.assets import encode_strings, decode_strings
+
+PROGRESSION_DICTS = ['meta', 'progression_class']
+SKIPPED_ATTRIBUTES = ['_progression', 'cache'] + PROGRESSION_DICTS
+
+
+def _plain(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return tuple(_plain(v) for v in value)
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+class _Column:
+    """categorical column under construction"""
+
+    def __init__(self, name):
+        self.name = name
+        self.codes = []
+        self.vocab = {}
+
+    def append(self, value, present=True):
+        if not present:
+            self.codes.append(-1)
+            return
+        encoded = repr(_plain(value))
+        if encoded not in self.vocab:
+            if ast.literal_eval(encoded) != value:
+                raise ValueError('cannot store {} = {!r} in a progression store'.format(self.name, value))
+            self.vocab[encoded] = len(self.vocab)
+        self.codes.append(self.vocab[encoded])
+
+    def pad(self, length):
+        self.codes += [-1] * (length - len(self.codes))
+
+    def arrays(self, prefix):
+        vocab, vocab_offsets = encode_strings(list(self.vocab))
+        dtype = np.int8 if len(self.vocab) < 1 << 7 else np.int16 if len(self.vocab) < 1 << 15 else np.int32
+        return {
+            prefix + self.name: np.array(self.codes, dtype=dtype),
+            prefix + self.name + ':vocab': vocab,
+            prefix + self.name + ':vocab_offsets': vocab_offsets,
+        }
+
+
+def _columns_append(columns, row, values):
+    for name, value in values.items():
+        if name not in columns:
+            columns[name] = _Column(name)
+            columns[name].pad(row)
+        columns[name].append(value)
+    for name, column in columns.items():
+        if name not in values:
+            column.append(None, present=False)
+
+
+def build_progression_store(progressions):
+    """list or dict of lists of ChordProgression -> bundle arrays"""
+    arrays = {}
+    if isinstance(progressions, dict):
+        keys = _Column('key')
+        group_offsets = [0]
+        flat = []
+        for key, group in progressions.items():
+            keys.append(key)
+            flat += group
+            group_offsets.append(len(flat))
+        arrays.update(keys.arrays('group:'))
+        arrays['group_offsets'] = np.array(group_offsets, dtype=np.int64)
+        progressions = flat
+
+    fields, chord_fields = {}, {}
+    bar_offsets, chord_offsets = [0], [0]
+    chord_count = 0
+    for row, progression in enumerate(progressions):
+        values = {}
+        for dict_name in PROGRESSION_DICTS:
+            for key, value in getattr(progression, dict_name).items():
+                values[dict_name + '.' + key] = value
+        for name, value in vars(progression).items():
+            if name not in SKIPPED_ATTRIBUTES:
+                values['attr.' + name] = value
+        _columns_append(fields, row, values)
+        for bar in progression.get_chord_progression():
+            for chord in bar:
+                _columns_append(chord_fields, chord_count, vars(chord))
+                chord_count += 1
+            chord_offsets.append(chord_count)
+        bar_offsets.append(len(chord_offsets) - 1)
+
+    arrays['bar_offsets'] = np.array(bar_offsets, dtype=np.int64)
+    arrays['chord_offsets'] = np.array(chord_offsets, dtype=np.int64)
+    arrays['fields'], arrays['fields_offsets'] = encode_strings(list(fields))
+    arrays['chord_fields'], arrays['chord_fields_offsets'] = encode_strings(list(chord_fields))
+    for column in fields.values():
+        arrays.update(column.arrays('field:'))
+    for column in chord_fields.values():
+        arrays.update(column.arrays('chord:'))
+    return arrays
+
+
+class _Vocabularies:
+
+    def __init__(self, bundle, prefix):
+        self._bundle = bundle
+        self._prefix = prefix
+        self._values = {}
+
+    def codes(self, name):
+        return self._bundle[self._prefix + name]
+
+    def values(self, name):
+        if name not in self._values:
+            encoded = decode_strings(self._bundle[self._prefix + name + ':vocab'],
+                                     self._bundle[self._prefix + name + ':vocab_offsets'])
+            self._values[name] = [ast.literal_eval(item) for item in encoded]
+        return self._values[name]
+
+
+def _fresh(value):
+    return copy.deepcopy(value) if isinstance(value, (list, dict, set)) else value
+
+
+class ProgressionStore(Sequence):
+    """Read-only sequence of ChordProgression backed by a bundle."""
+
+    def __init__(self, bundle):
+        self._bundle = bundle
+        self._bar_offsets = bundle['bar_offsets']
+        self._chord_offsets = bundle['chord_offsets']
+        self._fields = decode_strings(bundle['fields'], bundle['fields_offsets'])
+        self._chord_fields = decode_strings(bundle['chord_fields'], bundle['chord_fields_offsets'])
+        self._field_vocab = _Vocabularies(bundle, 'field:')
+        self._chord_vocab = _Vocabularies(bundle, 'chord:')
+        self._decoders = None
+        self._materialised = {}
+
+    def __len__(self):
+        return len(self._bar_offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('progression index out of range')
+        if item not in self._materialised:
+            self._materialised[item] = self._materialise(item)
+        return self._materialised[item]
+
+    def column(self, name):
+        """codes and decoded vocabulary of one progression field, e.g. 'progression_class.duplicate-id'"""
+        return self._field_vocab.codes(name), self._field_vocab.values(name)
+
+    def chord_counts(self):
+        """number of chords in each progression, without building any of them"""
+        return np.diff(self._chord_offsets[self._bar_offsets])
+
+    def _columns(self, vocabularies, names):
+        # (name, codes, values) per column; codes as lists, indexing numpy scalars one by one is slow
+        return [(name, vocabularies.codes(name).tolist(), vocabularies.values(name)) for name in names]
+
+    def _materialise(self, row):
+        if self._decoders is None:
+            self._decoders = (self._columns(self._field_vocab, self._fields),
+                              self._columns(self._chord_vocab, self._chord_fields),
+                              self._bar_offsets.tolist(), self._chord_offsets.tolist())
+        fields, chord_fields, bar_offsets, chord_offsets = self._decoders
+
+        progression = ChordProgression.__new__(ChordProgression)
+        attributes = {name: {} for name in PROGRESSION_DICTS}
+        for name, codes, values in fields:
+            if codes[row] < 0:
+                continue
+            value = _fresh(values[codes[row]])
+            kind, key = name.split('.', 1)
+            if kind == 'attr':
+                attributes[key] = value
+            else:
+                attributes[kind][key] = value
+        bars = []
+        for bar in range(bar_offsets[row], bar_offsets[row + 1]):
+            chords = []
+            for index in range(chord_offsets[bar], chord_offsets[bar + 1]):
+                chord = Chord.__new__(Chord)
+                chord.__dict__.update((name, _fresh(values[codes[index]]))
+                                      for name, codes, values in chord_fields if codes[index] >= 0)
+                chords.append(chord)
+            bars.append(chords)
+        attributes['_progression'] = bars
+        attributes['cache'] = {'2d-root': None}
+        progression.__dict__.update(attributes)
+        return progression
+
+
+class ProgressionGroups(Mapping):
+    """Read-only dict of lists of ChordProgression backed by a bundle."""
+
+    def __init__(self, bundle):
+        self._bundle = bundle
+        self._offsets = bundle['group_offsets']
+        keys = _Vocabularies(bundle, 'group:')
+        key_values = keys.values('key')
+        self._rows = {key_values[code]: row for row, code in enumerate(keys.codes('key').tolist())}
+        self._store = ProgressionStore(bundle)
+        self._groups = {}
+
+    def __getitem__(self, key):
+        if key not in self._groups:
+            row = self._rows[key]
+            self._groups[key] = self._store[self._offsets[row]:self._offsets[row + 1]]
+        return self._groups[key]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+
+def progression_view(bundle):
+    return ProgressionGroups(bundle) if 'group_offsets' in bundle else ProgressionStore(bundle)
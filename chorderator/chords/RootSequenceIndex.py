@@ -0,0 +1,87 @@
+"""
+Index of the chord root sequences of a progression library, for the
+transition score of DP.
+
+A template "contains" a chord sequence when the sequence appears as a
+contiguous run of the template's roots after repeated roots are merged
+(1 1 4 4 5 -> 1 4 5). Sequences of a single chord are never counted.
+
+RootSequenceIndex counts, for each n-gram of merged roots, the number of
+templates that contain it. The table for a length n is built the first time
+a sequence of that length is asked for, after which a count is a dict lookup
+instead of a scan over every template. count_by_scan is the original scan
+and is kept as the reference the index must agree with.
+"""
+from collections import Counter
+
+
+def merge_repeated(sequence):
+    """1 1 4 4 5 1 -> 1 4 5 1"""
+    merged = [sequence[0]]
+    for item in sequence:
+        merged.append(item) if item != merged[-1] else None
+    return merged
+
+
+def transition_chord_sequences(prev_template, cur_template):
+    """
+    All chord sequences that run across the boundary of prev_template and cur_template:
+    a suffix of the last bar of prev followed by a prefix of the first bar of cur.
+    """
+    chord_sequence_prev = merge_repeated(prev_template.progression[-1])
+
+    chord_sequence_cur = [cur_template.progression[-1][0]]
+    for i in cur_template.progression[0]:
+        chord_sequence_cur.append(i) if i != chord_sequence_cur[-1] else None
+
+    prev_part = [chord_sequence_prev[i:] for i in range(len(chord_sequence_prev))]
+    cur_part = [chord_sequence_cur[:i + 1] for i in range(len(chord_sequence_cur))]
+
+    return [merge_repeated(prev + cur) for prev in prev_part for cur in cur_part]
+
+
+def count_by_scan(templates, chord_sequences):
+    """number of (template, chord sequence) pairs where the template contains the sequence, by brute force"""
+    score = 0
+    for template in templates:
+        unique_temp = merge_repeated(template.get(only_root=True, flattened=True))
+        for chord_sequence in chord_sequences:
+            if len(chord_sequence) > len(unique_temp):
+                continue
+            all_slices = [unique_temp[i:i + len(chord_sequence)]
+                          for i in range(len(unique_temp) - len(chord_sequence) + 1)]
+            all_slices = [slc for slc in all_slices if len(slc) != 1]
+            for slc in all_slices:
+                if slc == chord_sequence:
+                    score += 1
+                    break
+    return score
+
+
+class RootSequenceIndex:
+
+    def __init__(self, templates):
+        self._sequences = [tuple(merge_repeated(template.get(only_root=True, flattened=True)))
+                           for template in templates]
+        self._counts = {}  # n -> Counter of n-grams, each template counted once
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def __ngram_counts(self, n):
+        if n not in self._counts:
+            counts = Counter()
+            for sequence in self._sequences:
+                counts.update({sequence[i:i + n] for i in range(len(sequence) - n + 1)})
+            self._counts[n] = counts
+        return self._counts[n]
+
+    def count(self, chord_sequence):
+        """number of templates containing chord_sequence"""
+        if len(chord_sequence) < 2:
+            return 0
+        return self.__ngram_counts(len(chord_sequence)).get(tuple(chord_sequence), 0)
+
+    def score(self, chord_sequences):
+        """same as count_by_scan(templates, chord_sequences)"""
+        return sum(self.count(chord_sequence) for chord_sequence in chord_sequences)
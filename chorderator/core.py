@@ -3,15 +3,10 @@ import inspect
 import json
 import os
 import warnings
-import numpy as np
-import pandas as pd
-import torch
-from .utils.utils import listen, pickle_read
+from .utils.utils import listen, segmentation_to_phrase
+from .utils.assets import as_song_index, load_asset, LazyCache
 from .utils.excp import handle_exception
-from .utils.pipeline import Pipeline
-from .settings import MAXIMUM_CORES, ACCOMONTAGE_DATA_DIR
-
-from .chords.ChordProgression import read_progressions
+from .settings import MAXIMUM_CORES, PREFETCH_TEXTURE_DATA
 
 
 class Core:
@@ -30,8 +25,15 @@ class Core:
         'meta.meter': ['4/4', '3/4'],
     }
 
+    # cache entries only the texture model (AccoMontage) needs
+    texture_cache = ['state_dict', 'phrase_data', 'edge_weights', 'song_index']
+
+    # model classes by name, imported on first use (the texture model pulls in torch)
+    _models = {}
+
     def __init__(self):
 
+        # model names, see get_pipeline_models
         self._pipeline = [self.preprocess_model(), self.main_model(), self.postprocess_model(), self.texture_model()]
         self.state = 0
         self.pipeline = None
@@ -45,14 +47,10 @@ class Core:
         self.output_style = '*'
         self.texture_spotlight = []
         self.texture_prefilter = None
-        self.cache = {
-            'dict': None,
-            'lib': None,
-            'state_dict': None,
-            'phrase_data': None,
-            'edge_weights': None,
-            'song_index': None,
-        }
+        self.texture_prefetch = PREFETCH_TEXTURE_DATA
+        self.k_best = 1
+        self._main_processor = None  # main model of the last run, solved again incrementally by the next one
+        self.cache = self.__create_cache()
 
     # def __new__(cls, *args, **kwargs):
     #     if not hasattr(cls, '_instance_list'):
@@ -75,7 +73,7 @@ class Core:
         return Core()
 
     def get_pipeline_models(self):
-        return self._pipeline
+        return [self.__import_model(model) if model else model for model in self._pipeline]
 
     def set_pipeline(self, pre=None, main=None, post=None, texture=None):
         if pre:
@@ -119,44 +117,80 @@ class Core:
             assert 0 <= prefilter[0] <= 4 and 0 <= prefilter[1] <= 4 and len(prefilter) == 2
             self.texture_prefilter = prefilter
 
+    def set_texture_prefetch(self, prefetch: bool):
+        self.texture_prefetch = prefetch
+
+    def set_k_best(self, k: int):
+        assert k >= 1
+        self.k_best = k
+
+    def get_progression_alternatives(self):
+        """
+        (progression list, score) of the k_best best chord progressions of the last generate, best first.
+        Any of them can be rendered without solving again: generate(cut_in='from_post', cut_in_arg=progression list).
+        """
+        return self.pipeline.progression_alternatives if self.pipeline is not None else []
+
     def set_cache(self, **kwargs):
-        for cache_name in ['lib, dict, state_dict', 'phrase_data', 'edge_weights', 'song_index']:
+        for cache_name in ['lib', 'dict', 'rep', 'trans', 'template_sets', 'state_dict', 'phrase_data', 'edge_weights',
+                           'song_index']:
             if cache_name in kwargs:
-                self.cache[cache_name] = kwargs[cache_name]
+                self.cache[cache_name] = kwargs[cache_name] if cache_name != 'song_index' \
+                    else as_song_index(kwargs[cache_name])
                 print(f'using cached {cache_name}')
+        if 'rep' in kwargs and 'template_sets' not in kwargs:
+            # templates and indexes of the new library, the old ones belong to the previous one
+            from .utils.models.DP import TemplateSets
+            self.cache['template_sets'] = TemplateSets(kwargs['rep'])
 
-    def load_data(self):
-        self.cache = {
-            'dict': read_progressions('dict'),
-            'lib': pickle_read('lib'),
-            'state_dict': torch.load(ACCOMONTAGE_DATA_DIR + '/model_master_final.pt', map_location=torch.device('cpu')) \
-                if not torch.cuda.is_available() else torch.load(ACCOMONTAGE_DATA_DIR + '/model_master_final.pt',
-                                                                 map_location=torch.device('cuda')),
-            'phrase_data': np.load(ACCOMONTAGE_DATA_DIR + '/phrase_data0714.npz', allow_pickle=True),
-            'edge_weights': np.load(ACCOMONTAGE_DATA_DIR + '/edge_weights_0714.npz', allow_pickle=True),
-            'song_index': pd.read_excel(ACCOMONTAGE_DATA_DIR + '/POP909 4bin quntization/four_beat_song_index.xlsx'),
-        }
+    @staticmethod
+    def __create_cache():
+        from .chords.ChordProgression import read_progressions
+
+        def template_sets():
+            # the DP templates resolved against 'rep', per mode and filter set (see DP.TemplateSets)
+            from .utils.models.DP import TemplateSets
+            return TemplateSets(cache['rep'])
+
+        # every entry is loaded on first access, see LazyCache
+        cache = LazyCache({
+            'dict': lambda: read_progressions('dict'),
+            'rep': lambda: read_progressions('rep'),
+            'trans': lambda: load_asset('trans'),
+            'template_sets': template_sets,
+            'lib': lambda: load_asset('lib'),
+            'state_dict': lambda: load_asset('state_dict'),
+            'phrase_data': lambda: load_asset('phrase_data'),
+            'edge_weights': lambda: load_asset('edge_weights'),
+            'song_index': lambda: load_asset('song_index'),
+        })
+        return cache
+
+    def load_data(self, lazy=False):
+        self.cache = self.__create_cache()
+        if not lazy:
+            self.cache.load()
         return self.cache
 
     def preprocess_model(self, model_name=registered['pre'][0]):
         if model_name not in Core.registered['pre']:
             return False
-        return self.__import_model(model_name)
+        return model_name
 
     def main_model(self, model_name=registered['main'][0]):
         if model_name not in Core.registered['main']:
             return False
-        return self.__import_model(model_name)
+        return model_name
 
     def postprocess_model(self, model_name=registered['post'][0]):
         if model_name not in Core.registered['post']:
             return False
-        return self.__import_model(model_name)
+        return model_name
 
     def texture_model(self, model_name=registered['texture'][0]):
         if model_name not in Core.registered['texture']:
             return False
-        return self.__import_model(model_name)
+        return model_name
 
     def get_state(self):
         if self.state <= 5:
@@ -169,16 +203,24 @@ class Core:
 
     @staticmethod
     def __import_model(model_name):
+        if model_name in Core._models:
+            return Core._models[model_name]
         surpass = ['Chord', 'ChordProgression', 'MIDILoader', 'Logging', 'Instrument', 'PrettyMIDI', 'Note']
         try:
             m = importlib.import_module('.utils.models.' + model_name, package='chorderator')
-        except:
+        except ModuleNotFoundError:
             m = importlib.import_module('.utils.models.accomontage.' + model_name, package='chorderator')
-        for cls in dir(m):
-            if inspect.isclass(getattr(m, cls)) and cls not in surpass:
-                return getattr(m, cls)
+        if inspect.isclass(getattr(m, model_name, None)):
+            model = getattr(m, model_name)
         else:
-            return False
+            for cls in dir(m):
+                if inspect.isclass(getattr(m, cls)) and cls not in surpass:
+                    model = getattr(m, cls)
+                    break
+            else:
+                return False
+        Core._models[model_name] = model
+        return model
 
     def verify(self):
         if False in self._pipeline:
@@ -197,12 +239,14 @@ class Core:
             return 100
 
     def __check_midi_path(self):
-        return 301 if self.midi_path == '' else 100
+        if self.midi_path is None or isinstance(self.midi_path, str) and self.midi_path == '':
+            return 301
+        return 100
 
     def __check_phrase(self):
         if not self.phrase:
             if self.segmentation:
-                self.phrase = self.__segmentation_to_phrase(self.segmentation)
+                self.phrase = segmentation_to_phrase(self.segmentation)
             else:
                 return 311
         cursor = 1
@@ -219,7 +263,7 @@ class Core:
                 self.segmentation = self.__phrase_to_segmentation(self.phrase)
             else:
                 return 311
-        phrase = self.__segmentation_to_phrase(self.segmentation)
+        phrase = segmentation_to_phrase(self.segmentation)
         cursor = 1
         while cursor < len(phrase):
             if phrase[cursor] - phrase[cursor - 1] not in self.registered['phrase']:
@@ -265,13 +309,11 @@ class Core:
         return 351
 
     def run(self, cut_in, cut_in_arg, with_texture, **kwargs):
-        self.pipeline = Pipeline(self._pipeline)
-        if self.cache['dict'] is None:
-            templates = read_progressions('dict')
-            self.cache['dict'] = templates
-        if self.cache['lib'] is None:
-            lib = pickle_read('lib')
-            self.cache['lib'] = lib
+        from .utils.pipeline import Pipeline
+        self.pipeline = Pipeline(self.get_pipeline_models())
+        if with_texture and self.texture_prefetch:
+            # load the texture data in the background while the chord stage runs
+            self.cache.prefetch(self.texture_cache)
         self.pipeline.send_in(self.midi_path,
                               cut_in=cut_in,
                               cut_in_arg=cut_in_arg,
@@ -282,40 +324,34 @@ class Core:
                               output_progression_style=self.output_progression_style,
                               output_chord_style=self.output_chord_style,
                               output_style=self.output_style,
-                              lib=self.cache['lib'],
-                              templates=self.cache['dict'],
-                              state_dict=self.cache['state_dict'],
-                              phrase_data=self.cache['phrase_data'],
-                              edge_weights=self.cache['edge_weights'],
-                              song_index=self.cache['song_index'],
+                              cache=self.cache,
                               segmentation=self.segmentation,
                               texture_spotlight=self.texture_spotlight,
                               texture_prefilter=self.texture_prefilter,
+                              k_best=self.k_best,
+                              main_processor=self._main_processor,
                               **kwargs)
+        if self.pipeline.main_processor is not None:
+            self._main_processor = self.pipeline.main_processor
         return self.pipeline.send_out()
 
+    def close(self):
+        """stop the worker processes of the kept main model, if any, and forget it; the next run solves from scratch"""
+        if self._main_processor is not None and hasattr(self._main_processor, 'close'):
+            self._main_processor.close()
+        self._main_processor = None
+
     # added APIs, making it similar with package API
-    def set_melody(self, midi_path: str):
+    def set_melody(self, midi_path):
+        """
+        a path, the bytes of a MIDI file, a binary file-like object, a PrettyMIDI or a note array
+        of rows (start, end, pitch[, velocity]) in seconds; see utils.utils.read_midi
+        """
         self.midi_path = midi_path
 
     def set_phrase(self, phrase: list):
         warnings.warn('set_phrase not supported currently, should use set_segmentation')
 
-    @staticmethod
-    def __segmentation_to_phrase(s):
-        phrase = [1]
-        memo = ''
-        for i in s:
-            if i == '\\':
-                return phrase
-            if not i.isdigit():
-                if memo != '':
-                    phrase.append(phrase[-1] + int(memo))
-                    memo = ''
-            else:
-                memo += i
-        return phrase[:-1]
-
     @staticmethod
     def __phrase_to_segmentation(p):
         seg = ''
@@ -325,12 +361,12 @@ class Core:
 
     def set_segmentation(self, segmentation):
         if self.phrase:
-            if self.phrase != self.__segmentation_to_phrase(segmentation):
+            if self.phrase != segmentation_to_phrase(segmentation):
                 warnings.warn(
                     'Segmentation {} not match phrase {}, using segmentation'.format(segmentation, self.phrase))
-                self.phrase = self.__segmentation_to_phrase(segmentation)
+                self.phrase = segmentation_to_phrase(segmentation)
         self.segmentation = segmentation + '\n'
-        self.phrase = self.__segmentation_to_phrase(self.segmentation)
+        self.phrase = segmentation_to_phrase(self.segmentation)
 
     def set_meta(self, tonic: str = None, mode: str = None, meter: str = None, tempo=None):
         if tonic is not None:
@@ -428,7 +464,8 @@ chord_gen_style = {}
 texture_spotlight = {}
 texture_prefilter = {})'''.format(self.state,
                                   self.pipeline,
-                                  self.midi_path,
+                                  self.midi_path if isinstance(self.midi_path, str)
+                                  else '<{}>'.format(type(self.midi_path).__name__),
                                   self.phrase,
                                   self.segmentation.rstrip('\n'),
                                   self.meta,
@@ -2,9 +2,12 @@ __all__ = ['set_meta', 'set_melody', 'set_output_progression_style', 'set_output
            'set_preprocess_model', 'set_main_model', 'set_postprocess_model', 'generate',
            'Key', 'Mode', 'Meter', 'Style', 'set_phrase', 'ChordStyle', 'ProgressionStyle', 'generate_save',
            'get_chorderator', 'set_texture_model', 'set_texture_prefilter', 'set_texture_spotlight', 'set_segmentation',
-           'get_current_config', 'load_data', 'set_note_shift']
+           'get_current_config', 'load_data', 'set_note_shift', 'set_texture_prefetch', 'PreforkPool',
+           'set_k_best', 'get_progression_alternatives', 'preprocess_batch']
 
 from .core import Core
+from .utils.batch import preprocess_batch
+from .utils.prefork import PreforkPool
 from .utils.utils import Logging
 
 _core = Core.get_core()
@@ -14,7 +17,8 @@ def get_chorderator():
     return Core.get_core()
 
 
-def set_melody(midi_path: str):
+def set_melody(midi_path):
+    """a path, MIDI bytes, a binary file-like object, a PrettyMIDI or a note array (start, end, pitch[, velocity])"""
     _core.set_melody(midi_path)
 
 
@@ -63,6 +67,18 @@ def set_note_shift(shift: int):
     _core.set_note_shift(shift)
 
 
+def set_texture_prefetch(prefetch: bool):
+    _core.set_texture_prefetch(prefetch)
+
+
+def set_k_best(k: int):
+    _core.set_k_best(k)
+
+
+def get_progression_alternatives():
+    return _core.get_progression_alternatives()
+
+
 def set_preprocess_model(name: str):
     _core.set_pipeline(pre=name)
     Logging.info('Preprocess model set as', name)
@@ -95,8 +111,8 @@ def get_current_config():
     return str(_core)
 
 
-def load_data():
-    return _core.load_data()
+def load_data(lazy=False):
+    return _core.load_data(lazy=lazy)
 
 
 class Key:
@@ -20,4 +20,42 @@ static_storage = {
     'rep': STATIC_DIR + 'representatives.pcls',
 }
 
+accomontage_storage = {
+    'state_dict': ACCOMONTAGE_DATA_DIR + '/model_master_final.pt',
+    'phrase_data': ACCOMONTAGE_DATA_DIR + '/phrase_data0714.npz',
+    'edge_weights': ACCOMONTAGE_DATA_DIR + '/edge_weights_0714.npz',
+    'song_index': ACCOMONTAGE_DATA_DIR + '/POP909 4bin quntization/four_beat_song_index.xlsx',
+}
+
+# compiled, memory-mappable versions of the assets above (see utils/assets.py)
+BUNDLE_DIR = STATIC_DIR + 'bundles/'
+bundle_storage = {
+    'lib': BUNDLE_DIR + 'lib.cdtb',
+    'dict': BUNDLE_DIR + 'dict.cdtb',
+    'rep': BUNDLE_DIR + 'rep.cdtb',
+    'trans': BUNDLE_DIR + 'trans.cdtb',
+    'concat_major': BUNDLE_DIR + 'concat_major.cdtb',
+    'concat_minor': BUNDLE_DIR + 'concat_minor.cdtb',
+    'state_dict': BUNDLE_DIR + 'state_dict.cdtb',
+    'phrase_data': BUNDLE_DIR + 'phrase_data.cdtb',
+    'edge_weights': BUNDLE_DIR + 'edge_weights.cdtb',
+    'song_index': BUNDLE_DIR + 'song_index.cdtb',
+}
+
+# derived texture-search data (reference pools, texture filters, chord features), keyed by the phrase data hash
+TEXTURE_CACHE_DIR = STATIC_DIR + 'cache/'
+
+# chord-stage solutions kept in memory (LRU), and optionally on disk, e.g. STATIC_DIR + 'cache/solutions/'
+SOLUTION_CACHE_SIZE = 256
+SOLUTION_CACHE_DIR = None
+
+# processes DP.solve scores candidates and transitions in (forked), 1 = in the calling process
+DP_WORKERS = 1
+
+# processes preprocess_batch parses and quantises melodies in (forked), 1 = in the calling process
+PREPROCESS_WORKERS = 1
+
 MAXIMUM_CORES = 3
+
+# load the texture model data in a background thread while the chord stage runs
+PREFETCH_TEXTURE_DATA = True
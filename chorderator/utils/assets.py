@@ -0,0 +1,648 @@
+"""
+Compiled asset bundles.
+
+A bundle holds one asset family in a single file: a fixed header, a JSON
+table of contents (dtype, shape and offset of every array) and the raw
+array data aligned to 64 bytes. Ragged data is stored as flat arrays plus
+offset tables. Bundles are memory-mapped read-only, so loading one costs a
+few syscalls and every process reading the same file shares its pages
+through the OS page cache.
+
+Use ``load_asset(name)`` to read an asset: it returns the bundle view when a
+compiled bundle exists and was built from the source file as it is now, and
+falls back to the original pickle / npz / torch files otherwise. Bundles are produced by ``compile_assets()``, or from the
+command line by ``python -m chorderator.build_assets``.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from .utils import Logging, pickle_read
+from ..settings import static_storage, accomontage_storage, bundle_storage
+
+BUNDLE_MAGIC = b'CDTB'
+BUNDLE_VERSION = 1
+
+_HEADER = struct.Struct('<4sIQ')  # magic, version, length of the table of contents
+_ALIGN = 64
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def write_bundle(path, arrays, meta=None):
+    toc = {'version': BUNDLE_VERSION, 'meta': meta if meta else {}, 'arrays': {}}
+    ordered, offset = [], 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError('cannot write object array "{}" into a bundle'.format(name))
+        offset = _align(offset)
+        toc['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        ordered.append((offset, array))
+        offset += array.nbytes
+    toc_bytes = json.dumps(toc, ensure_ascii=False).encode('utf-8')
+    data_start = _align(_HEADER.size + len(toc_bytes))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(toc_bytes)))
+        file.write(toc_bytes)
+        for array_offset, array in ordered:
+            file.seek(data_start + array_offset)
+            file.write(array.tobytes())
+        file.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class Bundle:
+    """Read-only, memory-mapped view of a bundle file. Arrays are not copied."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, toc_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError('{} is not an asset bundle'.format(path))
+        if version != BUNDLE_VERSION:
+            raise ValueError('{} has bundle version {}, expected {}'.format(path, version, BUNDLE_VERSION))
+        toc = json.loads(self._mmap[_HEADER.size:_HEADER.size + toc_length].decode('utf-8'))
+        self.meta = toc['meta']
+        self._arrays = toc['arrays']
+        self._data_start = _align(_HEADER.size + toc_length)
+
+    def __getitem__(self, name):
+        info = self._arrays[name]
+        shape = tuple(info['shape'])
+        count = 1
+        for dim in shape:
+            count *= dim
+        return np.frombuffer(self._mmap, dtype=np.dtype(info['dtype']), count=count,
+                             offset=self._data_start + info['offset']).reshape(shape)
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def keys(self):
+        return self._arrays.keys()
+
+
+# #######
+# Helpers
+# #######
+
+def encode_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(blob, offsets):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def ragged_to_flat(rows, dtype=None):
+    """list of arrays -> (arrays concatenated along axis 0, row offsets)"""
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(row) for row in rows])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=dtype if dtype else np.float64), offsets
+    flat = np.concatenate([np.asarray(row) for row in rows], axis=0)
+    return (flat.astype(dtype) if dtype else flat), offsets
+
+
+# #############
+# Source base
+# #############
+
+class SourceBase:
+    """dict-like view of source_base.pnt: source name -> [[start, end, pitch, velocity], ...]"""
+
+    def __init__(self, bundle):
+        self._bundle = bundle
+        self._notes = bundle['notes']
+        self._offsets = bundle['offsets']
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            names = decode_strings(self._bundle['names'], self._bundle['name_offsets'])
+            self._index = {name: i for i, name in enumerate(names)}
+        return self._index
+
+    def __getitem__(self, name):
+        i = self.index[name]
+        return self._notes[self._offsets[i]:self._offsets[i + 1]].tolist()
+
+    def get(self, name, default=None):
+        return self[name] if name in self.index else default
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+def _build_lib(lib):
+    names = list(lib.keys())
+    name_blob, name_offsets = encode_strings(names)
+    notes, offsets = ragged_to_flat([np.asarray(lib[name]).reshape(-1, 4) for name in names])
+    if notes.dtype.kind in 'iu':
+        notes = notes.astype(np.int32)
+    return {'names': name_blob, 'name_offsets': name_offsets, 'notes': notes, 'offsets': offsets}
+
+
+# ###########
+# Phrase data
+# ###########
+
+class RaggedPhrases:
+    """Stands in for the object arrays of phrase_data0714.npz: phrases[song_idx][phrase_idx] -> array"""
+
+    def __init__(self, rows, phrase_offsets, song_offsets):
+        self._rows = rows
+        self._phrase_offsets = phrase_offsets
+        self._song_offsets = song_offsets
+
+    @property
+    def shape(self):
+        return (len(self._song_offsets) - 1,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, song_idx):
+        first, last = self._song_offsets[song_idx], self._song_offsets[song_idx + 1]
+        return [self._rows[self._phrase_offsets[i]:self._phrase_offsets[i + 1]] for i in range(first, last)]
+
+
+class PhraseData:
+    """
+    phrase_data0714.npz: phrase_data[field][song_idx][phrase_idx]. The bundle also holds the
+    reference pools the texture search uses, see pool().
+    """
+    fields = ['melody', 'acc', 'chord']
+    pool_lengths = [8, 4, 6]
+
+    def __init__(self, bundle):
+        self._bundle = bundle
+        self._fields = {}
+
+    @property
+    def meta(self):
+        return self._bundle.meta
+
+    def pool(self, length):
+        """
+        (melody, acc, chord, song_reference) of the phrases that are `length` bars long and have
+        more than two melody notes, as find_by_length in AccoMontage returns them; song_reference
+        is an (N, 2) array of (song_idx, phrase_idx). The arrays are views into the bundle.
+        """
+        prefix = 'pool{}_'.format(length)
+        return tuple(self._bundle[prefix + name] for name in self.fields + ['song_reference'])
+
+    def __getitem__(self, field):
+        if field not in self._fields:
+            self._fields[field] = RaggedPhrases(self._bundle[field],
+                                                self._bundle[field + '_offsets'],
+                                                self._bundle['song_offsets'])
+        return self._fields[field]
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+
+def _build_phrase_data(data):
+    arrays = {}
+    song_offsets = None
+    for field in PhraseData.fields:
+        songs = data[field]
+        phrases = [phrase for song in songs for phrase in song]
+        arrays[field], arrays[field + '_offsets'] = ragged_to_flat(phrases)
+        offsets = np.zeros(len(songs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(song) for song in songs])
+        if song_offsets is not None and not np.array_equal(song_offsets, offsets):
+            raise ValueError('phrase_data fields do not share the same song/phrase layout')
+        song_offsets = offsets
+    arrays['song_offsets'] = song_offsets
+
+    # per-length pools, same selection and order as find_by_length
+    melody, melody_offsets = arrays['melody'], arrays['melody_offsets']
+    phrase_lengths = np.diff(melody_offsets)
+    starts = melody_offsets[:-1]
+    notes = np.add.reduceat(melody[:, :128].sum(axis=1), starts[phrase_lengths > 0]) \
+        if len(melody) else np.zeros(0)
+    note_counts = np.zeros(len(phrase_lengths))
+    note_counts[phrase_lengths > 0] = notes
+    song_of_phrase = np.repeat(np.arange(len(song_offsets) - 1), np.diff(song_offsets))
+    phrase_in_song = np.arange(len(phrase_lengths)) - song_offsets[song_of_phrase]
+    for length in PhraseData.pool_lengths:
+        picked = np.flatnonzero((phrase_lengths == length * 16) & (note_counts > 2))
+        for field in PhraseData.fields:
+            rows, offsets = arrays[field], arrays[field + '_offsets']
+            phrases = [rows[offsets[i]:offsets[i + 1]] for i in picked]
+            arrays['pool{}_{}'.format(length, field)] = np.stack(phrases) if phrases \
+                else np.zeros((0, 0) + rows.shape[1:], dtype=rows.dtype)
+        arrays['pool{}_song_reference'.format(length)] = np.stack([song_of_phrase[picked], phrase_in_song[picked]],
+                                                                  axis=-1).astype(np.int64)
+    return arrays
+
+
+# ##########
+# Song index
+# ##########
+
+class SongIndex:
+    """
+    POP909 song table (four_beat_song_index.xlsx) with hash indexes on song
+    name and artist. Row numbers are the song indices used by phrase_data.
+    """
+    columns = ['song_id', 'modify_times', 'num_beats_per_measure', 'num_quavers_per_beat']
+
+    def __init__(self, arrays):
+        self._arrays = arrays
+        self.names = decode_strings(arrays['names'], arrays['name_offsets'])
+        self.artists = decode_strings(arrays['artists'], arrays['artist_offsets'])
+        self._name_index = self.__build_index(self.names)
+        self._artist_index = self.__build_index(self.artists)
+
+    @staticmethod
+    def __build_index(values):
+        index = {}
+        for row, value in enumerate(values):
+            if value:
+                index.setdefault(value, []).append(row)
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def to_arrays(self):
+        return {name: self._arrays[name] for name in self._arrays}
+
+    def __getitem__(self, column):
+        return self._arrays[column]
+
+    def name(self, row):
+        return self.names[row]
+
+    def artist(self, row):
+        return self.artists[row]
+
+    def rows_by_name(self, name):
+        return self._name_index.get(name, [])
+
+    def rows_by_artist(self, artist):
+        return self._artist_index.get(artist, [])
+
+
+def as_song_index(song_index):
+    """a SongIndex as is, or one built from the song table as a pandas DataFrame"""
+    if isinstance(song_index, SongIndex):
+        return song_index
+    if hasattr(song_index, 'columns') and 'name' in song_index.columns and 'artist' in song_index.columns:
+        return SongIndex(_build_song_index(song_index))
+    raise ValueError('song_index should be a SongIndex or the song table as a DataFrame, got {}'
+                     .format(type(song_index).__name__))
+
+
+def _read_song_index():
+    import pandas as pd
+    return pd.read_excel(accomontage_storage['song_index'])
+
+
+def _build_song_index(df):
+    def to_str(value):
+        return '' if value != value or value is None else str(value)  # NaN for empty cells
+
+    arrays = {}
+    arrays['names'], arrays['name_offsets'] = encode_strings([to_str(v) for v in df['name']])
+    arrays['artists'], arrays['artist_offsets'] = encode_strings([to_str(v) for v in df['artist']])
+    for column in SongIndex.columns:
+        arrays[column] = df[column].to_numpy(dtype=np.float64 if column != 'song_id' else np.int64)
+    return arrays
+
+
+# ################
+# Asset families
+# ################
+
+def _raw_state_dict():
+    import torch
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    return torch.load(accomontage_storage['state_dict'], map_location=device)
+
+
+def _raw_npz(name):
+    return lambda: np.load(accomontage_storage[name], allow_pickle=True)
+
+
+def _bundle_state_dict(bundle):
+    import torch
+    return OrderedDict((name, torch.from_numpy(np.array(bundle[name]))) for name in bundle)
+
+
+def _build_state_dict(state_dict):
+    return {name: tensor.detach().cpu().numpy() for name, tensor in state_dict.items()}
+
+
+def _build_edge_weights(edge_weights):
+    return {name: edge_weights[name] for name in edge_weights}
+
+
+def _build_transition_scores(scores):
+    # keys are root sequences, with x.5 for roots between scale degrees
+    keys = list(scores)
+    flat, offsets = ragged_to_flat([np.asarray(key, dtype=np.float32) for key in keys])
+    return {
+        'keys': flat,
+        'int_keys': np.array([type(root) is int for key in keys for root in key], dtype=bool),
+        'key_offsets': offsets,
+        'scores': np.array([scores[key] for key in keys], dtype=np.float64),
+        'int_scores': np.array([type(scores[key]) is int for key in keys], dtype=bool),
+    }
+
+
+def _bundle_transition_scores(bundle):
+    # a plain dict, DP adds the scores it computes on the fly
+    flat = [int(root) if is_int else root for root, is_int in zip(bundle['keys'].tolist(), bundle['int_keys'].tolist())]
+    offsets = bundle['key_offsets'].tolist()
+    ints = bundle['int_scores'].tolist()
+    return {tuple(flat[offsets[i]:offsets[i + 1]]): int(score) if ints[i] else score
+            for i, score in enumerate(bundle['scores'].tolist())}
+
+
+def _build_template_scores(templates):
+    """concat_major / concat_minor: [(score, progression ids), ...]"""
+    flat, offsets = ragged_to_flat([np.asarray(ids, dtype=np.int64) for _, ids in templates], dtype=np.int32)
+    return {
+        'scores': np.array([score for score, _ in templates], dtype=np.float64),
+        'int_scores': np.array([type(score) is int for score, _ in templates], dtype=bool),
+        'ids': flat,
+        'id_offsets': offsets,
+        'tuple_ids': np.array([type(ids) is tuple for _, ids in templates], dtype=bool),
+    }
+
+
+def _bundle_template_scores(bundle):
+    flat, offsets = bundle['ids'].tolist(), bundle['id_offsets'].tolist()
+    ints, tuples = bundle['int_scores'].tolist(), bundle['tuple_ids'].tolist()
+    templates = []
+    for i, score in enumerate(bundle['scores'].tolist()):
+        ids = flat[offsets[i]:offsets[i + 1]]
+        templates.append((int(score) if ints[i] else score, tuple(ids) if tuples[i] else ids))
+    return templates
+
+
+def _progression_family(name):
+    # chords/ imports this module, so it is only imported when a progression library is actually read
+    def raw_loader():
+        from ..chords.ChordProgression import read_progressions
+        return read_progressions(name, compiled=False)
+
+    def from_bundle(bundle):
+        from ..chords.ProgressionStore import progression_view
+        return progression_view(bundle)
+
+    def build(progressions):
+        from ..chords.ProgressionStore import build_progression_store
+        return build_progression_store(progressions)
+
+    return static_storage[name], raw_loader, from_bundle, build
+
+
+# name: (source file, raw loader, bundle -> runtime object, raw object -> arrays)
+ASSET_FAMILIES = {
+    'lib': (static_storage['lib'], lambda: pickle_read('lib'), SourceBase, _build_lib),
+    'dict': _progression_family('dict'),
+    'rep': _progression_family('rep'),
+    'trans': (static_storage['trans'], lambda: pickle_read('trans'), _bundle_transition_scores,
+              _build_transition_scores),
+    'concat_major': (static_storage['concat_major'], lambda: pickle_read('concat_major'), _bundle_template_scores,
+                     _build_template_scores),
+    'concat_minor': (static_storage['concat_minor'], lambda: pickle_read('concat_minor'), _bundle_template_scores,
+                     _build_template_scores),
+    'state_dict': (accomontage_storage['state_dict'], _raw_state_dict, _bundle_state_dict, _build_state_dict),
+    'phrase_data': (accomontage_storage['phrase_data'], _raw_npz('phrase_data'), PhraseData, _build_phrase_data),
+    'edge_weights': (accomontage_storage['edge_weights'], _raw_npz('edge_weights'), lambda b: b,
+                     _build_edge_weights),
+    'song_index': (accomontage_storage['song_index'], lambda: SongIndex(_build_song_index(_read_song_index())),
+                   SongIndex, lambda song_index: song_index.to_arrays()),
+}
+
+
+# layout version of each family's arrays, bump it when a builder changes
+ASSET_SCHEMAS = {
+    'lib': 1,
+    'dict': 1,
+    'rep': 1,
+    'trans': 1,
+    'concat_major': 1,
+    'concat_minor': 1,
+    'state_dict': 1,
+    'phrase_data': 2,
+    'edge_weights': 1,
+    'song_index': 1,
+}
+
+
+def content_sha1(arrays):
+    """hash of the names, dtypes, shapes and data of a dict of arrays (or a Bundle)"""
+    sha1 = hashlib.sha1()
+    for name in sorted(arrays.keys()):
+        array = np.ascontiguousarray(arrays[name])
+        sha1.update(json.dumps([name, array.dtype.str, list(array.shape)]).encode('utf-8'))
+        sha1.update(memoryview(array).cast('B'))
+    return sha1.hexdigest()
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+_fresh_sources = {}  # source path -> (stamp, sha1) found to match a bundle, so it is hashed once per process
+
+
+def bundle_staleness(name, bundle):
+    """
+    None if the bundle was built from the source file of its family as it is now (or the source is
+    not there), else why it is stale. The size and mtime recorded at build time are compared first;
+    when they differ (e.g. a fresh checkout) the source is hashed and compared with source_sha1.
+    """
+    source = ASSET_FAMILIES[name][0]
+    if not os.path.exists(source):
+        return None
+    stamp, sha1 = source_stamp(source), bundle.meta.get('source_sha1')
+    if bundle.meta.get('source_stamp') == stamp or _fresh_sources.get(source) == (stamp, sha1):
+        return None
+    if sha1 != file_sha1(source):
+        return 'built from a different version of {}'.format(os.path.basename(source))
+    _fresh_sources[source] = (stamp, sha1)
+    return None
+
+
+def open_bundle(name):
+    path = bundle_storage[name]
+    if not os.path.exists(path):
+        return None
+    try:
+        bundle = Bundle(path)
+    except ValueError as e:
+        Logging.warning('ignoring bundle {}: {}'.format(path, e))
+        return None
+    if bundle.meta.get('schema') != ASSET_SCHEMAS[name]:
+        Logging.warning('ignoring bundle {}: schema {}, expected {}'.format(path, bundle.meta.get('schema'),
+                                                                            ASSET_SCHEMAS[name]))
+        return None
+    # a bundle left over from an older source would shadow the regenerated one
+    staleness = bundle_staleness(name, bundle)
+    if staleness is not None:
+        Logging.warning('ignoring bundle {}: {}, rebuild it with python -m chorderator.build_assets {}'
+                        .format(path, staleness, name))
+        return None
+    return bundle
+
+
+def load_asset(name):
+    source, raw_loader, from_bundle, _ = ASSET_FAMILIES[name]
+    bundle = open_bundle(name)
+    if bundle is not None:
+        Logging.info('map {} from {}'.format(name, bundle.path))
+        return from_bundle(bundle)
+    Logging.info('read {} from {}'.format(name, source))
+    return raw_loader()
+
+
+# name of the threads LazyCache.prefetch starts, see utils.forking
+PREFETCH_THREAD = 'chorderator-prefetch'
+
+
+class LazyCache(MutableMapping):
+    """
+    Cache entries that are loaded on first access. Each entry has a loader;
+    ``prefetch`` resolves some entries in a background thread, and an access
+    to an entry that is still being prefetched waits for it instead of
+    loading it twice.
+    """
+
+    def __init__(self, loaders):
+        self._loaders = dict(loaders)
+        self._values = {}
+        self._locks = {name: threading.Lock() for name in self._loaders}
+        self._overridden = set()  # entries set from outside rather than by their loader
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+        if name not in self._loaders:
+            raise KeyError(name)
+        with self._locks[name]:
+            if name not in self._values:
+                self._values[name] = self._loaders[name]()
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        if name not in self._locks:
+            self._locks[name] = threading.Lock()
+        self._values[name] = value
+        self._overridden.add(name)
+
+    def __delitem__(self, name):
+        self._values.pop(name, None)
+        self._loaders.pop(name, None)
+        self._overridden.discard(name)
+
+    def __iter__(self):
+        return iter(list(self._loaders) + [name for name in self._values if name not in self._loaders])
+
+    def __len__(self):
+        return len(set(self._loaders) | set(self._values))
+
+    def is_loaded(self, name):
+        return name in self._values
+
+    def is_overridden(self, name):
+        """True if the entry was set (e.g. by Core.set_cache) instead of coming from its loader"""
+        return name in self._overridden
+
+    def load(self, names=None):
+        for name in (names if names is not None else list(self)):
+            self[name]
+        return self
+
+    def prefetch(self, names):
+        names = [name for name in names if not self.is_loaded(name)]
+        if not names:
+            return None
+
+        def run():
+            for name in names:
+                try:
+                    self[name]
+                except Exception as e:
+                    Logging.warning('prefetching {} failed: {}'.format(name, e))
+
+        thread = threading.Thread(target=run, name=PREFETCH_THREAD, daemon=True)
+        thread.start()
+        return thread
+
+
+def compile_asset(name):
+    source, raw_loader, _, build = ASSET_FAMILIES[name]
+    if not os.path.exists(source):
+        Logging.warning('cannot compile {}: {} not found'.format(name, source))
+        return False
+    Logging.info('compiling {} from {}'.format(name, source))
+    arrays = build(raw_loader())
+    meta = {'family': name, 'schema': ASSET_SCHEMAS[name], 'source': os.path.basename(source),
+            'source_sha1': file_sha1(source), 'source_stamp': source_stamp(source),
+            'content_sha1': content_sha1(arrays)}
+    write_bundle(bundle_storage[name], arrays, meta=meta)
+    Logging.info('{} written to {}'.format(name, bundle_storage[name]))
+    return True
+
+
+def compile_assets(names=None):
+    return {name: compile_asset(name) for name in (names if names else ASSET_FAMILIES)}
@@ -0,0 +1,81 @@
+"""
+Pre-processing of many melodies at once, for offline catalog generation.
+
+    batch = preprocess_batch([{'melody': 'a.mid', 'meta': {'tonic': 'C'}, 'segmentation': 'A8B8'},
+                              {'melody': midi_bytes, 'meta': {'tonic': 'G', 'mode': 'min'}, 'segmentation': 'A8A8'}],
+                             workers=4)
+    for i in range(len(batch)):
+        if batch.errors[i] is None:
+            phrases = batch.phrases(i)
+
+Items are dicts like the configs of PreforkPool: 'melody' (anything
+set_melody accepts, see utils.utils.read_midi), 'meta', 'segmentation' and
+optionally 'note_shift'. They are parsed and quantised in a fork pool. An
+item that fails is reported in errors and does not stop the batch.
+"""
+import numpy as np
+
+from .forking import fork_pool
+from .models.PreProcessor import PreProcessor
+from .utils import read_midi, segmentation_to_phrase
+from ..settings import PREPROCESS_WORKERS
+
+
+class PreprocessedBatch:
+    """
+    The phrases of all items, back to back:
+
+    degrees : np.ndarray (float32)
+        Scale degree of every 16th (0 for rest) of every phrase.
+    phrase_offsets : np.ndarray (int64)
+        Phrase p is degrees[phrase_offsets[p]:phrase_offsets[p + 1]].
+    item_offsets : np.ndarray (int64)
+        The phrases of item i are item_offsets[i] to item_offsets[i + 1] - 1, none if it failed.
+    meta : list
+        Meta of each item as completed by the pre-processor (pos, tempo, unit), None if it failed.
+    errors : list
+        None, or the error of each failed item.
+    """
+
+    def __init__(self, results):
+        phrases = [phrase for phrase_list, _, _ in results for phrase in (phrase_list or [])]
+        self.degrees = np.concatenate(phrases) if phrases else np.zeros(0, dtype=np.float32)
+        self.phrase_offsets = np.cumsum([0] + [len(phrase) for phrase in phrases], dtype=np.int64)
+        self.item_offsets = np.cumsum([0] + [len(phrase_list or []) for phrase_list, _, _ in results], dtype=np.int64)
+        self.meta = [meta for _, meta, _ in results]
+        self.errors = [error for _, _, error in results]
+
+    def __len__(self):
+        return len(self.errors)
+
+    def phrases(self, i):
+        """the degree sequences of the phrases of item i, as lists"""
+        return [self.degrees[self.phrase_offsets[p]:self.phrase_offsets[p + 1]].tolist()
+                for p in range(self.item_offsets[i], self.item_offsets[i + 1])]
+
+
+def _preprocess(item):
+    try:
+        meta = dict(item['meta'])
+        meta.setdefault('meter', '4/4')
+        meta.setdefault('mode', 'maj')
+        # parsed here, so a bad path is an error of its own and not taken for a POP909 song name
+        midi = read_midi(item['melody'])
+        phrase = segmentation_to_phrase(item['segmentation'] + '\n')
+        processor = PreProcessor(midi, phrase, meta, item.get('note_shift', 0))
+        _, splited_melo, meta = processor.get(verbose=False)
+        return [np.asarray(phrase, dtype=np.float32) for phrase in splited_melo], meta, None
+    except Exception as e:
+        return None, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def preprocess_batch(items, workers=PREPROCESS_WORKERS):
+    """
+    Returns a PreprocessedBatch with the items in the order given.
+    """
+    items = list(items)
+    pool = fork_pool(workers, 'Batch pre-processing workers') if workers > 1 and len(items) > 1 else None
+    if pool is None:
+        return PreprocessedBatch([_preprocess(item) for item in items])
+    with pool:
+        return PreprocessedBatch(pool.map(_preprocess, items, max(1, len(items) // (workers * 4))))
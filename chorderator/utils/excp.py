@@ -1,5 +1,3 @@
-from .utils import Logging
-
 website = ' For more information, please visit https://...com.'
 
 
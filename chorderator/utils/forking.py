@@ -0,0 +1,31 @@
+"""
+Fork pools, for the parts that hand work to processes sharing this one's data
+(DP workers, batch pre-processing, pre-forked serving).
+"""
+import multiprocessing
+import threading
+
+from .assets import PREFETCH_THREAD
+from .utils import Logging
+
+
+def fork_pool(workers, purpose, **kwargs):
+    """
+    A multiprocessing Pool of workers forked from this process, or None, with a warning naming
+    purpose, when that cannot be done: no "fork" start method, or a daemon process, which cannot
+    have children. Callers run the work in this process then. A running data prefetch
+    (LazyCache.prefetch) is waited for before forking.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        Logging.warning('{} need the "fork" start method, running in one process'.format(purpose))
+        return None
+    if multiprocessing.current_process().daemon:
+        Logging.warning('{} cannot be started from a daemon process, running in one process'.format(purpose))
+        return None
+    # a thread holding a lock at fork time (an import, a cache entry it is loading) leaves that lock held
+    # forever in the children, so a running prefetch is waited for first
+    for thread in threading.enumerate():
+        if thread.name == PREFETCH_THREAD and thread is not threading.current_thread():
+            Logging.info('waiting for the data prefetch before forking {}'.format(purpose))
+            thread.join()
+    return multiprocessing.get_context('fork').Pool(workers, **kwargs)
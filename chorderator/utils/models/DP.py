@@ -1,5 +1,6 @@
 import copy
-import json
+import itertools
+import threading
 import time
 from typing import List
 import numpy as np
@@ -10,8 +11,187 @@ import pretty_midi
 
 from ...chords.Chord import Chord
 from ...chords.ChordProgression import ChordProgression, read_progressions, print_progression_list
-from ...utils.utils import MIDILoader, Logging, pickle_read
+from ...chords.RootSequenceIndex import RootSequenceIndex, transition_chord_sequences
+from ...utils.utils import MIDILoader, Logging
+from ...utils.assets import load_asset
+from ...utils.forking import fork_pool
+from ...utils.solution_cache import duplicate_id_map
 from ...utils.structured import major_map_backward, minor_map_backward
+from ...settings import DP_WORKERS
+
+# row: chord; col: melody, plus a last column of 0.5 for rests
+MUSICAL_KNOWLEDGE_M = np.array([
+    [1, 0.1, 0.4, 0.15, 0.75, 0.7, 0.1, 0.9, 0.1, 0.7, 0.15, 0.2, 0.5],
+    [0.4, 0.1, 1, 0.1, 0.4, 0.75, 0.4, 0.5, 0.1, 0.9, 0.15, 0.4, 0.5],
+    [0.5, 0.1, 0.4, 0.15, 1, 0.3, 0.2, 0.75, 0.2, 0.6, 0.15, 0.9, 0.5],
+    [0.9, 0.1, 0.6, 0.2, 0.5, 1, 0.1, 0.4, 0.4, 0.75, 0.2, 0.2, 0.5],
+    [0.5, 0.1, 0.9, 0.1, 0.5, 0.5, 0.1, 1, 0.1, 0.5, 0.75, 0.15, 0.5],
+    [0.75, 0.1, 0.6, 0.15, 0.9, 0.5, 0.1, 0.4, 0.1, 1, 0.15, 0.4, 0.5],
+    [0.4, 0.1, 0.8, 0.15, 0.6, 0.8, 0.1, 0.6, 0.1, 0.4, 0.15, 1, 0.5]
+])
+
+MUSICAL_KNOWLEDGE_m = np.array([
+    [1, 0.1, 0.4, 0.75, 0.15, 0.7, 0.1, 0.9, 0.7, 0.1, 0.2, 0.15, 0.5],
+    [0.4, 0.1, 1, 0.4, 0.1, 0.75, 0.4, 0.5, 0.9, 0.1, 0.4, 0.15, 0.5],
+    [0.5, 0.1, 0.4, 1, 0.15, 0.3, 0.2, 0.75, 0.6, 0.2, 0.9, 0.15, 0.5],
+    [0.9, 0.1, 0.6, 0.5, 0.2, 1, 0.1, 0.4, 0.75, 0.4, 0.2, 0.2, 0.5],
+    [0.5, 0.1, 0.9, 0.5, 0.1, 0.5, 0.1, 1, 0.5, 0.1, 0.75, 0.15, 0.5],
+    [0.75, 0.1, 0.6, 0.9, 0.15, 0.5, 0.1, 0.4, 1, 0.1, 0.4, 0.15, 0.5],
+    [0.4, 0.1, 0.8, 0.6, 0.15, 0.8, 0.1, 0.6, 0.4, 0.1, 1, 0.15, 0.5]
+])
+
+# 中观
+def match_template_and_pattern(template: [float, list]) -> float:
+
+    punish = 0
+    for temp in template[1]:
+        p = temp.get(flattened=True, only_root=True)
+        for chord in p:
+            if type(chord) is float:
+                punish = 0.1
+    return template[0] - punish
+
+
+class TemplateSet:
+    """
+    The concatenated templates of one mode and filter set, resolved to progressions of the library:
+    templates[j] = [中观分, [ChordProgression, ...]], grouped by total length in by_length.
+    """
+
+    def __init__(self, library, mode, only=(), without=()):
+        all_templates = load_asset('concat_major' if mode in ['maj', 'M'] else 'concat_minor')
+
+        if only:
+            only = set(only)
+            all_templates = [item for item in all_templates if all(i in only for i in item[1])]
+        if without:
+            without = set(without)
+            all_templates = [item for item in all_templates if not any(i in without for i in item[1])]
+
+        # 去重, 保留第一次出现的 (a list and a tuple of the same ids count as different, as list == tuple is False)
+        seen = set()
+        unique_templates = []
+        for item in all_templates:
+            key = (type(item[1]), tuple(item[1]))
+            if key not in seen:
+                seen.add(key)
+                unique_templates.append(item)
+
+        templates_id_dict = {temp.progression_class['duplicate-id']: temp for temp in library}
+        templates_length_dict = {id: len(temp) for id, temp in templates_id_dict.items()}
+        self.templates = []
+        self.by_length = {}  # 总长度 -> templates, 给pick_templates用
+        for item in unique_templates:
+            template = [item[0], [templates_id_dict[id] for id in item[1]]]
+            self.templates.append(template)
+            self.by_length.setdefault(sum(templates_length_dict[id] for id in item[1]), []).append(template)
+        self._bucket_arrays = {}
+        self._lock = threading.Lock()
+
+    def bucket_arrays(self, length):
+        # roots and 中观分 of every template of this total length, built on first use
+        if length not in self._bucket_arrays:
+            with self._lock:
+                if length not in self._bucket_arrays:
+                    templates = self.by_length.get(length, [])
+                    roots = np.empty((len(templates), length), dtype=np.intp)
+                    mid = np.empty(len(templates))
+                    for t, template in enumerate(templates):
+                        chord_list = []
+                        for progression in template[1]:
+                            chord_list += progression.get(only_root=True, flattened=True)
+                        roots[t] = [int(chord) - 1 for chord in chord_list]
+                        mid[t] = match_template_and_pattern(template)
+                    self._bucket_arrays[length] = (roots, mid)
+        return self._bucket_arrays[length]
+
+    def load(self):
+        for length in self.by_length:
+            self.bucket_arrays(length)
+        return self
+
+
+class TemplateSets:
+    """
+    TemplateSet of a progression library per (mode, filters), each built once on first use, and the other
+    indexes of the library the solver needs, kept here so they live (and are freed) with it.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self._sets = {}
+        self._root_index = None
+        self._by_duplicate_id = None
+        self._lock = threading.Lock()
+
+    def root_index(self):
+        """RootSequenceIndex of the library, for transitions missing from transition_score.mdch"""
+        if self._root_index is None:
+            with self._lock:
+                if self._root_index is None:
+                    self._root_index = RootSequenceIndex(self.library)
+        return self._root_index
+
+    def by_duplicate_id(self):
+        """{duplicate-id: progression}, to turn cached solutions back into progressions"""
+        if self._by_duplicate_id is None:
+            self._by_duplicate_id = duplicate_id_map(self.library)
+        return self._by_duplicate_id
+
+    def get(self, mode, only=(), without=()):
+        key = ('major' if mode in ['maj', 'M'] else 'minor', tuple(sorted(only)), tuple(sorted(without)))
+        if key not in self._sets:
+            with self._lock:
+                if key not in self._sets:
+                    self._sets[key] = TemplateSet(self.library, mode, only, without)
+        return self._sets[key]
+
+
+# the DP whose pool is being forked, inherited by its workers
+_solving = None
+
+
+def _call(name, args):
+    return getattr(_solving, name)(*args)
+
+
+class _Executor:
+    """
+    Maps a method of dp over argument tuples, in a fork pool if workers > 1. The pool is forked on first use
+    and kept until close(), so the workers hold dp as it was then (templates, transition scores, copy-on-write
+    instead of pickled): methods mapped here must take everything that changes between solves as arguments.
+    Transition scores computed for pairs missing from transition_score.mdch are returned by transition_block
+    and merged into dp, so later solves (and new workers) have them whichever worker computed them.
+    """
+
+    def __init__(self, dp, workers):
+        self.dp = dp
+        self.workers = workers
+        self.pool = None
+        self.started = False
+
+    def __call__(self, method, args_list):
+        if self.workers > 1 and not self.started:
+            self.__start()
+        if self.pool is None or len(args_list) < 2:
+            return [method(*args) for args in args_list]
+        return self.pool.starmap(_call, [(method.__name__, args) for args in args_list])
+
+    def __start(self):
+        global _solving
+        self.started = True
+        _solving = self.dp
+        try:
+            self.pool = fork_pool(self.workers, 'DP workers')
+        finally:
+            _solving = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.started = False
 
 
 class DP:
@@ -34,39 +214,69 @@ class DP:
         The meta info of the input melody.
     templates : List[ChordProgression]
         Template database. List of ChordProgressions.
+    template_sets : TemplateSets, optional
+        Resolved templates of this database, shared between DP instances (see Core.cache).
+    transition_dict : dict, optional
+        Transition scores (transition_score.mdch), shared between DP instances.
     """
 
     SOLVE_ONLY_WITH_THESE_PROGRESSIONS = [] # if empty, solve with all
     SOLVE_WITHOUT_THESE_PROGRESSIONS = [511, 128, 147]
 
-    def __init__(self, melo: list, melo_meta: dict, templates: List[ChordProgression], write_log=None):
+    # number of incoming transitions kept per node in the score report, the highest ones
+    REPORT_MACRO_TOP = 5
+
+    def __init__(self, melo: list, melo_meta: dict, templates: List[ChordProgression], write_log=None, k_best=1,
+                 report=False, workers=DP_WORKERS, template_sets=None, transition_dict=None):
         Logging.debug('init DP model...')
 
         self.melo = self.__split_melody(melo)  # melo : List(List) 是整首歌的melo
         self.melo_meta = self.__handle_meta(melo_meta)
 
         self.max_num = 10000  # 每一个phrase所对应chord progression的最多数量
-        self._dp = np.array(
-            [[None] * self.max_num] * len(self.melo))  # replace None by ([], 0) tuple of path index list and score
+        self._dp = []  # (scores, back pointers) of each phrase, see solve
         self.solved = False
         self.result = None
 
-        self.templates = self.__load_templates(templates)
-        self.transition_dict = self.__load_transition_dict()
-
-        # dp_score_report：记录dp中每个node的微观中观宏观分，以及当前总分和当前路径
-        # shape: (number of phrases, number of templates at each phrase)
-        # 每个element形如：{
-        #                     'progression_ids':[],
-        #                     'micro':0,
-        #                     'mid':0,
-        #                     'macro':[],
-        #                     'cumulative':0,
-        #                     'path':[],
-        #                 }
-        self.dp_score_report = []
-
+        # k_best > 1: also keep the k best paths into every node, see get_alternatives
+        if k_best < 1:
+            raise ValueError('k_best must be at least 1, got {}'.format(k_best))
+        self.k_best = k_best
+        self._k_best_dp = []  # (scores, back) of each phrase, shape (number of templates, k_best)
+        self.alternatives = None
+
+        # workers > 1: score candidates and build transition matrices in that many forked processes
+        self.workers = workers
+        self._executor = None  # forked on the first solve with workers > 1, see close
+        self._solve_state = None  # what the last solve computed, see update
+        self._report_layers = []
+
+        self.progression_library = templates
+        if template_sets is None or template_sets.library is not templates:
+            template_sets = TemplateSets(templates)
+        self.template_sets = template_sets
+        # the progression filters the templates were picked with, compared before the model is reused
+        self.template_filters = (tuple(sorted(self.SOLVE_ONLY_WITH_THESE_PROGRESSIONS)),
+                                 tuple(sorted(self.SOLVE_WITHOUT_THESE_PROGRESSIONS)))
+        self.template_set = template_sets.get(self.melo_meta['mode'], *self.template_filters)
+        self.templates = self.template_set.templates
+        self.transition_dict = transition_dict if transition_dict is not None else load_asset('trans')
+        # scores of transitions missing from transition_dict (shared, never written to), see transition_score
+        self.computed_transitions = {}
+
+        # dp_score_report：记录dp中每个node的微观中观宏观分，以及当前总分和back pointer, 默认不记录 (None)
+        # report=True 或 write_log 时为dict of arrays, nodes of all phrases one after another:
+        #   'layer_offsets'       phrase i owns nodes layer_offsets[i]:layer_offsets[i + 1]
+        #   'micro', 'mid', 'cumulative'   per node
+        #   'back'                index of the best previous node within its phrase, -1 in the first phrase
+        #   'macro_top_prev', 'macro_top_score'    shape (number of nodes, REPORT_MACRO_TOP): the highest
+        #                         transition scores into the node and the previous nodes they come from, -1 / nan padded
+        #   'progression_ids', 'progression_offsets'   node n's template is progression_ids[offsets[n]:offsets[n + 1]]
+        #   'path'                index of the picked node in each phrase
+        # write_log: 把report写到 output/<time>.npz
         self.write_log = write_log
+        self.report = report or bool(write_log)
+        self.dp_score_report = None
 
         Logging.debug('init DP model done')
 
@@ -81,81 +291,103 @@ class DP:
         # 这个weight是宏观 (transition) 的weight, wight 越大，宏观权重越少
         weight = 0.9
 
-        # iterate through phrases
+        # pick templates at every phrase
+        # 重复的乐段 (e.g. A8A8B8B8): melody, length and pos 都一样的phrase只选一次templates、算一次微观中观分
+        phrase_keys, picked = [], {}
         for i in range(len(self.melo)):
-
-            # self._dp的shape是(number of phrases, number of maximum available templates at a phrase)
-            # self._dp[i][j] = (path, score)
-            # path 是走到当前node的最佳路径
-            # score 是当前node的dp分数
-
-            # pick templates at current phrase i
             melo = self.melo[i]
             melo_meta = copy.copy(self.melo_meta)
             melo_meta['pos'] = self.melo_meta['pos'][i]
-            templates.append(self.pick_templates(melo, melo_meta))
-
-            current_layer_score_report = []
-
-            # calculate score for each available templates at current phrase i
-            for j in range(len(templates[i])):
+            phrase_key = (tuple(melo), len(melo) // 2, melo_meta['pos'])
+            if phrase_key not in picked:
+                picked[phrase_key] = self.pick_templates(melo, melo_meta)
+            phrase_keys.append(phrase_key)
+            templates.append(picked[phrase_key])
+
+        # 上一次solve以后只改了后面的phrase (see update): 前面没变的layers直接用上次的结果, 从第一个变了的layer往后重新算
+        # 微观中观分 per distinct phrase and transition matrices per pair of neighbouring phrases are reused too
+        previous_state = self._solve_state if self._solve_state is not None else {'keys': [], 'scores': {},
+                                                                                  'transitions': {}}
+        first_changed = 0
+        while first_changed < min(len(phrase_keys), len(previous_state['keys'])) \
+                and phrase_keys[first_changed] == previous_state['keys'][first_changed]:
+            first_changed += 1
+
+        # 算一下还没有的微观中观分 (每个distinct phrase一次) 和transition matrix
+        # 这些都不依赖dp分数，workers > 1 时分给多个进程算
+        new_phrases = [i for i, key in enumerate(phrase_keys)
+                       if key not in previous_state['scores'] and phrase_keys.index(key) == i]
+        pairs = [(phrase_keys[i - 1], phrase_keys[i]) for i in range(1, len(phrase_keys))]
+        new_pairs = [i for i in range(1, len(phrase_keys))
+                     if pairs[i - 1] not in previous_state['transitions'] and pairs.index(pairs[i - 1]) == i - 1]
+        blocks = [(i, start, min(start + self.TRANSITION_BLOCK, len(templates[i])))
+                  for i in new_pairs for start in range(0, len(templates[i]), self.TRANSITION_BLOCK)]
+        executor = self.__executor()
+        layer_scores = executor(self.layer_template_scores, [(self.melo[i],) for i in new_phrases])
+        transition_blocks = executor(self.transition_block,
+                                     [(self.melo_meta['pos'][i], len(self.melo[i]) // 2, len(self.melo[i - 1]) // 2,
+                                       start, stop) for i, start, stop in blocks])
+
+        phrase_scores = {key: previous_state['scores'][key] for key in phrase_keys if key in previous_state['scores']}
+        phrase_scores.update({phrase_keys[i]: scores for i, scores in zip(new_phrases, layer_scores)})
+        pair_transitions = {pair: previous_state['transitions'][pair] for pair in pairs
+                            if pair in previous_state['transitions']}
+        for i in new_pairs:
+            pair_transitions[pairs[i - 1]] = np.empty((0, len(templates[i - 1][:self.max_num])))
+        for (i, start, _), (block, computed) in zip(blocks, transition_blocks):
+            self.computed_transitions.update(computed)
+            pair_transitions[pairs[i - 1]] = np.concatenate([pair_transitions[pairs[i - 1]], block])
+        self._solve_state = {'keys': phrase_keys, 'scores': phrase_scores, 'transitions': pair_transitions}
+
+        del self._dp[first_changed:]
+        del self._k_best_dp[first_changed:]
+        del self._report_layers[first_changed:]
 
-                current_element_score_report = {
-                    'progression_ids':[progression.id for progression in templates[i][j][1]],
-                    'micro':0,
-                    'mid':0,
-                    'macro':[],
-                    'cumulative':0,
-                    'path':[],
-                }
+        # iterate through phrases
+        for i in range(first_changed, len(self.melo)):
 
-                # 算一下微观和中观分并记录
-                # micro_and_mid = (微观中观综合分，微观分，中观分)
-                micro_and_mid = self.phrase_template_score(self.melo[i], templates[i][j])
-                current_element_score_report['micro'] = micro_and_mid[1]
-                current_element_score_report['mid'] = micro_and_mid[2]
+            # self._dp[i] = (scores, back)
+            # scores[j] 是第i层第j个node的dp分数
+            # back[j] 是走到这个node的最佳路径在上一层(i-1)的index，路径最后一次性回溯
 
-                if i == 0:
-                    self._dp[i][j] = ([j], micro_and_mid[0])
+            # local, micro, mid: 每个template的微观中观综合分，微观分，中观分
+            local, micro, mid = phrase_scores[phrase_keys[i]]
 
-                else:
+            if i == 0:
+                self._dp.append((local, None))
+                transition = None
 
-                    # previous: 上一层(i-1)的每一个progression转移到当前progression(第i层的第j个)的score都是多少
-                    previous = []
-                    for t in range(min([self.max_num, len(templates[i - 1])])):
-                        transition = self.transition_score(melo_meta['pos'],
-                                                           templates[i][j][1][0],
-                                                           templates[i - 1][t][1][-1])
-                        current_element_score_report['macro'].append(transition)
-                        previous.append(weight * self._dp[i - 1][t][1] + (1 - weight) * transition)
+            else:
 
-                    # 找到上一层转移到当前progression的分最大的那个progression的分和index
-                    max_previous = max(previous)
-                    max_previous_index = previous.index(max(previous))
+                # transition[j][t]: 上一层(i-1)的第t个progression转移到当前progression(第i层的第j个)的score
+                prev_scores = self._dp[i - 1][0][:self.max_num]
+                transition = pair_transitions[pairs[i - 1]]
+                previous = weight * prev_scores[np.newaxis, :] + (1 - weight) * transition
 
-                    # path_l 是走到当前progression的最优路径
-                    path_l = copy.copy(self._dp[i - 1][max_previous_index][0])
-                    path_l.append(j)
+                # 找到上一层转移到当前progression的分最大的那个progression的index (并列时取第一个)
+                back = np.argmax(previous, axis=1)
+                scores = local + previous[np.arange(len(back)), back]
+                self._dp.append((scores, back))
 
-                    # 记录dp score和path
-                    self._dp[i][j] = (path_l, micro_and_mid[0] + max_previous)
-                    current_element_score_report['path'] = self._dp[i][j][0]
-                    current_element_score_report['cumulative'] = self._dp[i][j][1]
+            if self.k_best > 1:
+                self.__k_best_step(local, transition, weight)
 
-                current_layer_score_report.append(current_element_score_report)
+            if self.report:
+                self._report_layers.append(self.__report_layer(templates[i], micro, mid, self._dp[i], transition))
 
-            Logging.debug('dp with i = {}: '.format(i), self._dp[i])
-            self.dp_score_report.append(current_layer_score_report)
+            Logging.debug('dp with i = {}: '.format(i), self._dp[i][0])
 
         # 记录生成和弦进行的分数用于定量横向比较生成和弦的质量（不同旋律间对比），除以乐段数量因为每一段都会加分
-        # print([self._dp[-1][i][1] for i in range(min([self.max_num, len(templates[-1])]))])
-        # 找到最高分
-        max_score = max([self._dp[-1][i][1] for i in range(min([self.max_num, len(templates[-1])]))])
-        best_score = max_score / len(self.melo)
+        # 找到最后一层分最高的那个node
+        last_scores = self._dp[-1][0][:self.max_num]
+        last_index = int(np.argmax(last_scores))
+        best_score = float(last_scores[last_index]) / len(self.melo)
 
-        # 找到最后一层分最高的那个node,获取走到这个node的最佳路径，存在result_path_index里面
-        last_index = [self._dp[-1][i][1] for i in range(min([self.max_num, len(templates[-1])]))].index(max_score)
-        result_path_index = self._dp[-1][last_index][0]
+        # 沿着back回溯走到这个node的最佳路径，存在result_path_index里面
+        result_path_index = [last_index]
+        for i in range(len(self.melo) - 1, 0, -1):
+            result_path_index.append(int(self._dp[i][1][result_path_index[-1]]))
+        result_path_index.reverse()
 
         # 从result_path_index获取template本身，构建result_path
         result_path = []
@@ -165,26 +397,168 @@ class DP:
 
         self.solved = True
         self.result = (result_path, best_score)
+        if self.k_best > 1:
+            self.alternatives = self.__k_best_paths(templates)
 
-        if self.write_log:
-            file = open('output/'+str(time.time())+'.json', 'w')
-            json.dump(self.dp_score_report, file)
-            file.close()
+        if self.report:
+            self.dp_score_report = self.__join_report(self._report_layers, result_path_index)
+            if self.write_log:
+                np.savez_compressed('output/' + str(time.time()) + '.npz', **self.dp_score_report)
 
         return result_path, best_score, self.dp_score_report
 
+    def __report_layer(self, templates, micro, mid, dp, transition):
+        scores, back = dp
+        top = self.REPORT_MACRO_TOP
+        macro_top_prev = np.full((len(templates), top), -1, dtype=np.int32)
+        macro_top_score = np.full((len(templates), top), np.nan, dtype=np.float32)
+        if transition is not None and transition.size:
+            order = np.argsort(-transition, axis=1, kind='stable')[:, :top]
+            macro_top_prev[:, :order.shape[1]] = order
+            macro_top_score[:, :order.shape[1]] = np.take_along_axis(transition, order, axis=1)
+        progression_ids = [[progression.id for progression in template[1]] for template in templates]
+        return {
+            'micro': micro,
+            'mid': mid,
+            'cumulative': scores,
+            'back': back if back is not None else np.full(len(templates), -1),
+            'macro_top_prev': macro_top_prev,
+            'macro_top_score': macro_top_score,
+            'progression_ids': [i for ids in progression_ids for i in ids],
+            'progression_counts': [len(ids) for ids in progression_ids],
+        }
+
+    @staticmethod
+    def __join_report(layers, path):
+        report = {name: np.concatenate([np.asarray(layer[name]) for layer in layers])
+                  for name in ['micro', 'mid', 'cumulative', 'back', 'macro_top_prev', 'macro_top_score']}
+        report['back'] = report['back'].astype(np.int32)
+        report['progression_ids'] = np.array([i for layer in layers for i in layer['progression_ids']],
+                                             dtype=np.int32)
+        report['progression_offsets'] = np.concatenate(
+            [[0], np.cumsum([n for layer in layers for n in layer['progression_counts']])]).astype(np.int64)
+        report['layer_offsets'] = np.concatenate([[0], np.cumsum([len(layer['micro']) for layer in layers])]) \
+            .astype(np.int64)
+        report['path'] = np.array(path, dtype=np.int32)
+        return report
+
+    def update(self, melo, melo_meta=None):
+        """
+        Replace the melody phrases and, if given, the melody meta (positions, tonic, ...), e.g. after an edit.
+        The mode cannot change, the templates are picked for it. The next solve keeps the layers before the
+        first changed phrase and recomputes from there on, reusing the scores of unchanged phrases.
+        """
+        if melo_meta is not None:
+            melo_meta = self.__handle_meta(melo_meta)
+            if self.__is_major(melo_meta['mode']) != self.__is_major(self.melo_meta['mode']):
+                raise ValueError('cannot update a DP of mode {} to mode {}, create a new one'
+                                 .format(self.melo_meta['mode'], melo_meta['mode']))
+            self.melo_meta = melo_meta
+        self.melo = self.__split_melody(melo)
+        self.solved = False
+        self.result = None
+        self.alternatives = None
+
+    # rows of a transition matrix computed as one task
+    TRANSITION_BLOCK = 256
+
+    def transition_block(self, pos, length, prev_length, start, stop):
+        # rows start:stop of the transition matrix from the templates of total length prev_length to those of length,
+        # and the scores computed for it that were not in computed_transitions yet
+        known = len(self.computed_transitions)
+        block = self.transition_matrix(pos, self.templates_of_length(length)[start:stop],
+                                       self.templates_of_length(prev_length)[:self.max_num])
+        return block, dict(itertools.islice(self.computed_transitions.items(), known, None))
+
+    def __executor(self):
+        if self._executor is None:
+            self._executor = _Executor(self, self.workers)
+        return self._executor
+
+    def close(self):
+        """stop the worker processes, if any; a later solve forks new ones"""
+        if self._executor is not None:
+            self._executor.close()
+
+    # cand entries per block when keeping the k best, bounds the memory of a k-best step
+    K_BEST_BLOCK = 1 << 20
+
+    def __k_best_step(self, local, transition, weight):
+        # scores[j][r]: r-th best score of a path ending at node j, -inf if there are fewer than k paths
+        # back[j][r]: t * k + r' of the node and rank in the previous layer that path comes from
+        k = self.k_best
+        if transition is None:
+            scores = np.full((len(local), k), -np.inf)
+            scores[:, 0] = local
+            self._k_best_dp.append((scores, None))
+            return
+        prev_scores = self._k_best_dp[-1][0][:self.max_num]
+        scores = np.empty((len(local), k))
+        back = np.empty((len(local), k), dtype=np.intp)
+        block = max(1, self.K_BEST_BLOCK // (prev_scores.size or 1))
+        for start in range(0, len(local), block):
+            stop = min(start + block, len(local))
+            # same expression as the 1-best step, so rank 0 agrees with it exactly
+            previous = weight * prev_scores[np.newaxis, :, :] + (1 - weight) * transition[start:stop, :, np.newaxis]
+            previous = previous.reshape(stop - start, -1)
+            # stable: ties keep the lower (node, rank), like np.argmax
+            order = np.argsort(-previous, axis=1, kind='stable')[:, :k]
+            back[start:stop] = order
+            scores[start:stop] = local[start:stop, np.newaxis] + np.take_along_axis(previous, order, axis=1)
+        self._k_best_dp.append((scores, back))
+
+    def __k_best_paths(self, templates):
+        k = self.k_best
+        last_scores = self._k_best_dp[-1][0][:self.max_num].reshape(-1)
+        alternatives = []
+        for flat in np.argsort(-last_scores, kind='stable')[:k]:
+            if last_scores[flat] == -np.inf:
+                break
+            node, rank = divmod(int(flat), k)
+            path_index = [node]
+            for i in range(len(self.melo) - 1, 0, -1):
+                node, rank = divmod(int(self._k_best_dp[i][1][node, rank]), k)
+                path_index.append(node)
+            path_index.reverse()
+            alternatives.append(([templates[i][index] for i, index in enumerate(path_index)],
+                                 float(last_scores[flat]) / len(self.melo)))
+        return alternatives
+
+    def transition_matrix(self, pos, cur_templates, prev_templates):
+        """
+        transition_score of every (cur, prev) template pair, shape (len(cur_templates), len(prev_templates)).
+        A transition only depends on the last progression of prev and the first progression of cur,
+        so it is computed once per distinct pair of progressions and broadcast.
+        """
+        prev_progressions, prev_index = self.__distinct([template[1][-1] for template in prev_templates])
+        cur_progressions, cur_index = self.__distinct([template[1][0] for template in cur_templates])
+        scores = np.array([[self.transition_score(pos, cur, prev) for prev in prev_progressions]
+                           for cur in cur_progressions], dtype=float).reshape(len(cur_progressions), -1)
+        return scores[np.ix_(cur_index, prev_index)]
+
+    @staticmethod
+    def __distinct(progressions):
+        # distinct progression objects (in order of appearance) and the index of each item among them
+        positions, distinct, index = {}, [], []
+        for progression in progressions:
+            if id(progression) not in positions:
+                positions[id(progression)] = len(distinct)
+                distinct.append(progression)
+            index.append(positions[id(progression)])
+        return distinct, np.array(index, dtype=np.intp)
+
     # input是分好段的melo
-    def pick_templates(self, melo, melo_meta):
+    @staticmethod
+    def __is_major(mode):
+        return mode in ['maj', 'M']
 
-        available_templates = []
-        for template in self.templates:
+    def templates_of_length(self, length):
+        return self.template_set.by_length.get(length, [])
 
-            # 找到总长度匹配的，加入候选名单
-            total_temp_length = 0
-            for i in template[1]:
-                total_temp_length += len(i)
-            if total_temp_length == len(melo) // 2:
-                available_templates.append(template)
+    def pick_templates(self, melo, melo_meta):
+
+        # 找到总长度匹配的，加入候选名单
+        available_templates = self.templates_of_length(len(melo) // 2)
 
         if len(available_templates) == 0:
             print('no matched length')
@@ -228,69 +602,64 @@ class DP:
         mid = self.__match_template_and_pattern(chord)
         return weight * mid + (1 - weight) * micro, micro, mid
 
+    # 微观 + 中观 of all templates of one phrase at once
+    # returns arrays (微观中观综合分，微观分，中观分), one entry per template in pick_templates(melo)
+    def layer_template_scores(self, melo, weight=0.5):
+        roots, mid = self.template_set.bucket_arrays(len(melo) // 2)
+        micro = self.__match_melody_and_chords(melo, roots)
+        return weight * mid + (1 - weight) * micro, micro, mid
+
     # 微观
     @staticmethod
     def __match_melody_and_chord(melody_list: list, progression: List[ChordProgression], mode='M') -> float:
-        musical_knowledge_M = [  # row: chord; col: melody
-            [1, 0.1, 0.4, 0.15, 0.75, 0.7, 0.1, 0.9, 0.1, 0.7, 0.15, 0.2],
-            [0.4, 0.1, 1, 0.1, 0.4, 0.75, 0.4, 0.5, 0.1, 0.9, 0.15, 0.4],
-            [0.5, 0.1, 0.4, 0.15, 1, 0.3, 0.2, 0.75, 0.2, 0.6, 0.15, 0.9],
-            [0.9, 0.1, 0.6, 0.2, 0.5, 1, 0.1, 0.4, 0.4, 0.75, 0.2, 0.2],
-            [0.5, 0.1, 0.9, 0.1, 0.5, 0.5, 0.1, 1, 0.1, 0.5, 0.75, 0.15],
-            [0.75, 0.1, 0.6, 0.15, 0.9, 0.5, 0.1, 0.4, 0.1, 1, 0.15, 0.4],
-            [0.4, 0.1, 0.8, 0.15, 0.6, 0.8, 0.1, 0.6, 0.1, 0.4, 0.15, 1]
-        ]
-
-        musical_knowledge_m = [  # row: chord; col: melody
-            [1, 0.1, 0.4, 0.75, 0.15, 0.7, 0.1, 0.9, 0.7, 0.1, 0.2, 0.15],
-            [0.4, 0.1, 1, 0.4, 0.1, 0.75, 0.4, 0.5, 0.9, 0.1, 0.4, 0.15],
-            [0.5, 0.1, 0.4, 1, 0.15, 0.3, 0.2, 0.75, 0.6, 0.2, 0.9, 0.15],
-            [0.9, 0.1, 0.6, 0.5, 0.2, 1, 0.1, 0.4, 0.75, 0.4, 0.2, 0.2],
-            [0.5, 0.1, 0.9, 0.5, 0.1, 0.5, 0.1, 1, 0.5, 0.1, 0.75, 0.15],
-            [0.75, 0.1, 0.6, 0.9, 0.15, 0.5, 0.1, 0.4, 1, 0.1, 0.4, 0.15],
-            [0.4, 0.1, 0.8, 0.6, 0.15, 0.8, 0.1, 0.6, 0.4, 0.1, 1, 0.15]
-        ]
-
-        total_score = 0.0
         chord_list = []
         for i in range(len(progression)):
             for j in progression[i].get(only_root=True, flattened=True):
                 chord_list.append(j)
+        roots = np.array([[int(chord) - 1 for chord in chord_list]], dtype=np.intp).reshape(1, -1)
+        return float(DP.__match_melody_and_chords(melody_list, roots, mode)[0])
 
-        for i in range(len(chord_list)):
-            # this_chord = chord_list[i].to_number(tonic='C')
-            this_chord = chord_list[i]
-            if mode == 'M':
-                this_note = [major_map_backward[melody_list[i * 2]], major_map_backward[melody_list[i * 2 + 1]]]
-                total_score += musical_knowledge_M[int(this_chord) - 1][this_note[0]] if this_note[0] != -1 else 0.5
-                total_score += musical_knowledge_M[int(this_chord) - 1][this_note[1]] if this_note[1] != -1 else 0.5
-            else:
-                this_note = [minor_map_backward[melody_list[i * 2]], minor_map_backward[melody_list[i * 2 + 1]]]
-                total_score += musical_knowledge_m[int(this_chord) - 1][this_note[0]] if this_note[0] != -1 else 0.5
-                total_score += musical_knowledge_m[int(this_chord) - 1][this_note[1]] if this_note[1] != -1 else 0.5
-        # print("微观", total_score / len(melody_list), [p.progression_class['duplicate-id'] for p in progression])
+    # 微观 of many chord sequences of the same length
+    # roots: int array (number of templates, number of chords), int(root) - 1 of each chord
+    @staticmethod
+    def __match_melody_and_chords(melody_list: list, roots: np.ndarray, mode='M') -> np.ndarray:
+        if mode == 'M':
+            knowledge, backward = MUSICAL_KNOWLEDGE_M, major_map_backward
+        else:
+            knowledge, backward = MUSICAL_KNOWLEDGE_m, minor_map_backward
+        # two melody notes per chord; a rest (-1) picks the last column, 0.5
+        notes = np.array([backward[note] for note in melody_list[:2 * roots.shape[1]]], dtype=np.intp)
+        scores = knowledge[roots[:, :, np.newaxis], notes.reshape(-1, 2)[np.newaxis, :, :]]
+        # summed left to right like the original note-by-note loop, so the totals are bit-identical
+        total_score = np.cumsum(scores.reshape(len(roots), -1), axis=1)[:, -1] if scores.size \
+            else np.zeros(len(roots))
         return total_score / len(melody_list)
 
     # 中观
-    def __match_template_and_pattern(self, template: [float, list]) -> float:
-
-        punish = 0
-        for temp in template[1]:
-            p = temp.get(flattened=True, only_root=True)
-            for chord in p:
-                if type(chord) is float:
-                    punish = 0.1
-        return template[0] - punish
-
     @staticmethod
-    def __load_transition_dict():
-        return pickle_read('trans')
+    def __match_template_and_pattern(template: [float, list]) -> float:
+        return match_template_and_pattern(template)
+
+    def root_sequence_index(self):
+        # built on the first transition missing from transition_score.mdch, once per TemplateSets (so per library)
+        return self.template_sets.root_index()
 
     # transition prob between i-th phrase and (i-1)-th
     def transition_score(self, i, cur_template, prev_template):
-        transition_bars = prev_template.progression[-1] + cur_template.progression[0]
-        if tuple(transition_bars) in self.transition_dict:
-            return self.transition_dict[tuple(transition_bars)]
+        transition_bars = tuple(prev_template.progression[-1] + cur_template.progression[0])
+        if transition_bars in self.transition_dict:
+            return self.transition_dict[transition_bars]
+
+        # 不在transition_score.mdch里的分数还取决于cur的最后一个和弦和两边的cycle, 按这些存算好的分数,
+        # 这样再次查到的和第一次算的一样, 不管之前算过哪些transition
+        cur_cycle = cur_template.progression_class['cycle']
+        prev_cycle = prev_template.progression_class['cycle']
+        key = (transition_bars, cur_template.progression[-1][0], cur_cycle[1], prev_cycle[1])
+        if key not in self.computed_transitions:
+            self.computed_transitions[key] = self.__compute_transition_score(cur_template, prev_template)
+        return self.computed_transitions[key]
+
+    def __compute_transition_score(self, cur_template, prev_template):
 
         # 计算和弦变换速度是否匹配
         # prev_duration = 1
@@ -311,72 +680,28 @@ class DP:
 
         # first bar of cur cp and last bar of prev cp 接在一起对这两个小节做中观打分
         # search for the occurrence of such chord sequence, regardless of chord duration
-
-        chord_sequence_prev = [prev_template.progression[-1][0]]
-        for i in prev_template.progression[-1]:
-            chord_sequence_prev.append(i) if i != chord_sequence_prev[-1] else None
-
-        chord_sequence_cur = [cur_template.progression[-1][0]]
-        for i in cur_template.progression[0]:
-            chord_sequence_cur.append(i) if i != chord_sequence_cur[-1] else None
-
-        prev_part = [chord_sequence_prev[i:] for i in range(len(chord_sequence_prev))]
-        cur_part = [chord_sequence_cur[:i + 1] for i in range(len(chord_sequence_cur))]
-
         # chord_sequences contains all sequences of chord that contains the transition two chords in the transition bars
-
-        chord_sequences_dup = []
-        for i in range(len(prev_part)):
-            for j in range(len(cur_part)):
-                chord_sequences_dup.append(prev_part[i] + cur_part[j])
-
-        chord_sequences = []
-        for c in chord_sequences_dup:
-            new = [c[0]]
-            for i in c:
-                new.append(i) if i != new[-1] else None
-            chord_sequences.append(new)
+        chord_sequences = transition_chord_sequences(prev_template, cur_template)
 
         # search the number of occurrence in the template space
-        score = 0
-        for template in self.templates:
-            unique_temp = [template.get(only_root=True, flattened=True)[0]]
-            for i in template.get(only_root=True, flattened=True):
-                unique_temp.append(i) if i != unique_temp[-1] else None
-            for chord_sequence in chord_sequences:
-                # if chord_sequence in unique_temp:
-                #     score += 1
-                if len(chord_sequence) > len(unique_temp):
-                    continue
-                all_slices = [unique_temp[i:i + len(chord_sequence)]
-                              for i in range(len(unique_temp) - len(chord_sequence) + 1)]
-                new = []
-                for slc in all_slices:
-                    if len(slc) != 1:
-                        new.append(slc)
-                all_slices = new
-                # print(all_slices, chord_sequence)
-                for slc in all_slices:
-                    if slc == chord_sequence:
-                        score += 1
-                        break
+        root_index = self.root_sequence_index()
+        score = root_index.score(chord_sequences)
 
         # new_score = log_{max_score}(score)
 
-        self.transition_dict[tuple(transition_bars)] = score
-
-        if cur_template.cycle[1] == 0 or prev_template.cycle[1] == 0:
+        cur_cycle = cur_template.progression_class['cycle']
+        prev_cycle = prev_template.progression_class['cycle']
+        if cur_cycle[1] == 0 or prev_cycle[1] == 0:
             cycle_penalty = 1
         else:
-            if cur_template.cycle[1] == prev_template.cycle[1]:
+            if cur_cycle[1] == prev_cycle[1]:
                 cycle_penalty = 1
-            elif cur_template.cycle[1] / prev_template.cycle[1] <= 2 or prev_template.cyclep[1] / cur_template.cycle[
-                1] <= 2:
+            elif cur_cycle[1] / prev_cycle[1] <= 2 or prev_cycle[1] / cur_cycle[1] <= 2:
                 cycle_penalty = 0.95
             else:
                 cycle_penalty = 0.9
 
-        return score * cycle_penalty / len(self.templates)
+        return score * cycle_penalty / len(root_index)
 
     def __split_melody(self, melo):
         if type(melo[0]) is list:
@@ -391,55 +716,22 @@ class DP:
         except:
             raise Exception('Model cannot handle melody meta in this form yet.')
 
-    def __load_templates(self, templates):
-
-        if self.melo_meta['mode'] == 'maj' or self.melo_meta['mode'] == 'M':
-            all_templates = pickle_read('concat_major')
-        else:
-            all_templates = pickle_read('concat_minor')
-
-        if self.SOLVE_ONLY_WITH_THESE_PROGRESSIONS:
-            all_templates_new = []
-            for score_id_list_item in all_templates:
-                for progression_id in score_id_list_item[1]:
-                    if progression_id not in self.SOLVE_ONLY_WITH_THESE_PROGRESSIONS:
-                        break
-                else:
-                    all_templates_new.append(score_id_list_item)
-            all_templates = all_templates_new
-
-        if self.SOLVE_WITHOUT_THESE_PROGRESSIONS:
-            all_templates_new = []
-            for score_id_list_item in all_templates:
-                for progression_id in score_id_list_item[1]:
-                    if progression_id in self.SOLVE_WITHOUT_THESE_PROGRESSIONS:
-                        break
-                else:
-                    all_templates_new.append(score_id_list_item)
-            all_templates = all_templates_new
-
-        all_templates_new = []
-        duplicate_checker = []
-        for score_id_list_item in all_templates:
-            if score_id_list_item[1] not in duplicate_checker:
-                all_templates_new.append(score_id_list_item)
-                duplicate_checker.append(score_id_list_item[1])
-        all_templates = all_templates_new
-
-        templates_id_dict = {temp.progression_class['duplicate-id']: temp for temp in templates}
-        replaced_by_progression = []
-        for score_id_list_item in all_templates:
-            replaced_by_progression.append([score_id_list_item[0],
-                                            [templates_id_dict[id] for id in score_id_list_item[1]]
-                                            ])
-        return replaced_by_progression
-
     def get(self):
         if not self.solved:
             self.solve()
         picked_prog = [i[1] for i in self.result[0]]
         return picked_prog
 
+    def get_alternatives(self):
+        """
+        The k_best highest-scoring distinct paths, best first, as a list of (progressions like get(), score).
+        With k_best == 1 this is just the result of solve.
+        """
+        if not self.solved:
+            self.solve()
+        alternatives = self.alternatives if self.k_best > 1 else [self.result]
+        return [([i[1] for i in path], score) for path, score in alternatives]
+
     def get_progression_join_as_midi(self, tonic=None):
         progressions = self.get()
         if not tonic:
@@ -481,7 +773,7 @@ if __name__ == '__main__':
     my_dp_model.solve()
     print_progression_list(my_dp_model.get())
 
-    lib = pickle_read('lib')
+    lib = load_asset('lib')
     picked = my_dp_model.get()
     count = 1
     for i in picked:
@@ -1,6 +1,7 @@
 import copy
 import random
 
+import numpy as np
 from pretty_midi import Instrument
 
 from ...chords.ChordProgression import print_progression_list, read_progressions
@@ -107,42 +108,42 @@ class PostProcessor:
 
         velocity_dynamics = (30, 90)
         pitch_dynamic = (29, 74)
+        low_avg = (pitch_dynamic[1] - pitch_dynamic[0]) / 10 + pitch_dynamic[0]
+        high_avg = pitch_dynamic[1] - (pitch_dynamic[1] - pitch_dynamic[0]) / 10
 
-        def map_velocity(velocity):
-            return int((velocity_dynamics[1] - velocity_dynamics[0]) * (velocity / 128) + velocity_dynamics[0])
-
-        def is_note_list_in_pitch_dynamic(notes_index):
-            try:
-                avg = sum([note_list[idx].pitch for idx in notes_index]) / len(notes_index)
-                min_pitch = min([note_list[idx] for idx in notes_index], key=lambda x: x.pitch).pitch
-                max_pitch = max([note_list[idx] for idx in notes_index], key=lambda x: x.pitch).pitch
-                if avg < (pitch_dynamic[1] - pitch_dynamic[0]) / 10 + pitch_dynamic[0] or min_pitch < pitch_dynamic[0]:
-                    return -1
-                if avg > pitch_dynamic[1] - (pitch_dynamic[1] - pitch_dynamic[0]) / 10 or max_pitch > pitch_dynamic[1]:
-                    return 1
-                return 0
-            except:
-                return 0
-
-        for note in note_list:
-            note.velocity = map_velocity(note.velocity)
+        starts = np.array([note.start for note in note_list], dtype=np.float64)
+        pitches = np.array([note.pitch for note in note_list], dtype=np.int64)
+        velocities = np.array([note.velocity for note in note_list], dtype=np.int64)
+        velocities = ((velocity_dynamics[1] - velocity_dynamics[0]) * (velocities / 128)
+                      + velocity_dynamics[0]).astype(np.int64)
 
+        # four-bar windows [bounds[k], bounds[k + 1]), the cursor advanced by repeated addition as before
         four_bars_length = self.meta['unit'] * 64
-        max_end = max(note_list, key=lambda x: x.end).end
-        cursor = 0
-        while cursor <= max_end:
-            section_notes_index = []
-            for i in range(len(note_list)):
-                if cursor <= note_list[i].start < cursor + four_bars_length:
-                    section_notes_index.append(i)
-            compare_result = is_note_list_in_pitch_dynamic(section_notes_index)
-            if compare_result == 1:
-                for idx in section_notes_index:
-                    note_list[idx].pitch -= 12
-            elif compare_result == -1:
-                for idx in section_notes_index:
-                    note_list[idx].pitch += 12
-            cursor += four_bars_length
+        max_end = max(note.end for note in note_list)
+        bounds = [0]
+        while bounds[-1] <= max_end:
+            bounds.append(bounds[-1] + four_bars_length)
+
+        # notes sorted by start, so each window is a slice
+        order = np.argsort(starts, kind='stable')
+        cuts = np.searchsorted(starts[order], bounds, side='left')
+        counts = np.diff(cuts)
+        windowed = order[cuts[0]:cuts[-1]]
+        shift = np.zeros(len(counts), dtype=np.int64)
+        filled = counts > 0
+        if filled.any():
+            window_pitches = pitches[windowed]
+            offsets = cuts[:-1][filled] - cuts[0]
+            avg = np.add.reduceat(window_pitches, offsets) / counts[filled]
+            too_low = (avg < low_avg) | (np.minimum.reduceat(window_pitches, offsets) < pitch_dynamic[0])
+            too_high = (avg > high_avg) | (np.maximum.reduceat(window_pitches, offsets) > pitch_dynamic[1])
+            # a window both too low and too high is moved up
+            shift[filled] = np.where(too_low, 12, np.where(too_high, -12, 0))
+        pitches[windowed] += np.repeat(shift, counts)
+
+        for note, pitch, velocity in zip(note_list, pitches.tolist(), velocities.tolist()):
+            note.pitch = pitch
+            note.velocity = velocity
         return note_list
 
     def __info(self, progression):
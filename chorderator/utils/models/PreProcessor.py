@@ -1,7 +1,8 @@
-from pretty_midi import PrettyMIDI, Instrument, Note
+import numpy as np
+from pretty_midi import Instrument, Note
 
 from ...utils.excp import handle_exception
-from ...utils.utils import MIDILoader
+from ...utils.utils import MIDILoader, read_midi
 from ...utils.structured import major_map, minor_map, str_to_root
 
 
@@ -9,18 +10,21 @@ class PreProcessor:
     accepted_phrase_length = [4, 8, 16, 12, 24, 32]
 
     def __init__(self, midi_path='', phrase=None, meta=None, note_shift=0, **kwargs):
+        # midi_path: anything read_midi accepts, or the name of a POP909 song
         try:
             self.midi_path = None
             self.note_shift = note_shift
-            self.midi = PrettyMIDI(midi_path)
+            self.midi = read_midi(midi_path)
             self.melo = self.midi.instruments[0]
         except:
+            if not isinstance(midi_path, str):
+                raise
             self.midi_path = midi_path
             self.melo = self.__load_pop909_melo()
         self.meta = meta
         self.phrase = phrase
 
-    def get(self):
+    def get(self, verbose=True):
 
         if self.midi_path is not None:
             pop909_loader = MIDILoader(files='POP909')
@@ -37,12 +41,14 @@ class PreProcessor:
             if 'tempo' not in self.meta.keys():
                 self.meta['tempo'] = self.midi.get_tempo_changes()[1][0]
                 self.meta['unit'] = 60 / self.meta['tempo'] / 4
-            print(self.meta)
+            if verbose:
+                print(self.meta)
 
         for i in splited_melo:
             if len(i) // 16 not in PreProcessor.accepted_phrase_length:
                 handle_exception(312)
-        print(splited_melo)
+        if verbose:
+            print(splited_melo)
         return self.melo, splited_melo, self.meta
 
     def __load_pop909_melo(self):
@@ -67,29 +73,28 @@ class PreProcessor:
     def __analyze_midi(self):
 
         def quantize_note(time, unit):
-            base = time // unit
-            return base if time % unit < unit / 2 else base + 1
+            # float // and % behave as for Python floats, so this rounds exactly as note by note did
+            base = np.floor_divide(time, unit)
+            return np.where(np.mod(time, unit) < unit / 2, base, base + 1)
 
         def pitch_to_number(pitch, meta):
             tonic_distance = str_to_root[meta['tonic']]
-            if meta['mode'] == 'maj':
-                return major_map[(pitch - tonic_distance) % 12]
-            else:
-                return minor_map[(pitch - tonic_distance) % 12]
+            degree_map = major_map if meta['mode'] == 'maj' else minor_map
+            return [degree_map[i] for i in ((pitch - tonic_distance) % 12).tolist()]
 
-        all_notes_and_pos = []
         if 'tempo' not in self.meta.keys():
             # unit = 60 / self.midi.estimate_tempo() / 4
             unit = 60 / self.midi.get_tempo_changes()[1][0] / 4
         else:
             unit = 60 / self.meta['tempo'] / 4
-        for note in self.midi.instruments[0].notes:
-            if quantize_note(note.end, unit) >= self.note_shift:
-                all_notes_and_pos.append([quantize_note(note.start, unit)-self.note_shift,
-                                          quantize_note(note.end, unit)-self.note_shift,
-                                          pitch_to_number(note.pitch, self.meta),
-                                          note.velocity])
-        melo_sequence = self.__construct_melo_sequence(all_notes_and_pos)
+        notes = self.midi.instruments[0].notes
+        starts = quantize_note(np.array([note.start for note in notes], dtype=np.float64), unit)
+        ends = quantize_note(np.array([note.end for note in notes], dtype=np.float64), unit)
+        pitches = np.array([note.pitch for note in notes], dtype=np.int64)
+        kept = ends >= self.note_shift
+        melo_sequence = self.__construct_melo_sequence(starts[kept] - self.note_shift,
+                                                       ends[kept] - self.note_shift,
+                                                       pitch_to_number(pitches[kept], self.meta))
         splited_melo = []
 
         if self.phrase[0] != 1:
@@ -106,15 +111,16 @@ class PreProcessor:
         return splited_melo
 
     @staticmethod
-    def __construct_melo_sequence(all_notes_and_pos):
+    def __construct_melo_sequence(starts, ends, degrees):
+        """
+        One degree per 16th (0 for rest). A note holds the cursor until it ends, even if
+        another starts meanwhile; then the cursor takes the first listed note sounding there.
+        """
 
         def fix_end(max_end):
             return int(((max_end // 4) + 1) * 4)
 
-        def is_note_playing_at_cursor(note, cursor):
-            return True if note[0] <= cursor < note[1] else False
-
-        max_end = max(all_notes_and_pos, key=lambda x: x[1])[1]
+        max_end = float(np.max(ends))
 
         fixed_end = fix_end(max_end // 16)
 
@@ -123,23 +129,27 @@ class PreProcessor:
         else:
             fixed_end *= 16
 
-        note_dict = {i: all_notes_and_pos[i] for i in range(len(all_notes_and_pos))}
-        melo_sequence, cache = [], -1
-        for cursor in range(fixed_end):
-            if cache != -1:
-                if is_note_playing_at_cursor(note_dict[cache], cursor):
-                    melo_sequence.append(note_dict[cache][2])
-                    continue
-                else:
-                    cache = -1
-            for (key, note) in note_dict.items():
-                if is_note_playing_at_cursor(note, cursor):
-                    melo_sequence.append(note[2])
-                    cache = key
-                    break
-            else:
-                melo_sequence.append(0)
-        return melo_sequence
+        starts = np.clip(starts, 0, fixed_end).astype(np.int64)
+        ends = np.clip(ends, 0, fixed_end).astype(np.int64)
+
+        # first listed note sounding at each 16th, -1 for rest; written backwards so earlier notes win
+        first = np.full(fixed_end, -1, dtype=np.int64)
+        for i in np.flatnonzero(starts < ends)[::-1].tolist():
+            first[starts[i]:ends[i]] = i
+        sounding = np.flatnonzero(first >= 0)
+
+        # a chosen note is held to its end, then the cursor jumps to the next sounding 16th
+        chosen = np.full(fixed_end, -1, dtype=np.int64)
+        cursor = 0
+        while True:
+            next_sounding = np.searchsorted(sounding, cursor)
+            if next_sounding == len(sounding):
+                break
+            cursor = sounding[next_sounding]
+            note = first[cursor]
+            chosen[cursor:ends[note]] = note
+            cursor = ends[note]
+        return np.array(list(degrees) + [0], dtype=object)[chosen].tolist()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,11 @@
 import numpy as np
-import pandas as pd
 
 from ....settings import ACCOMONTAGE_DATA_DIR
+from ....utils.assets import as_song_index, load_asset
 from .util_tools.acc_utils import split_phrases
 from .util_tools import format_converter_update as cvt
-from .util_tools.AccoMontage import find_by_length, dp_search, render_acc, ref_spotlight, get_texture_filter, \
-    render_acc_new
+from .util_tools.AccoMontage import dp_search, render_acc, ref_spotlight, render_acc_new
+from .util_tools.reference_cache import get_reference_pools
 
 import os
 
@@ -37,14 +37,11 @@ class AccoMontage:
 
         print('Loading Reference Data')
         if not self.phrase_data:
-            data = np.load(DATA_DIR + '/phrase_data0714.npz', allow_pickle=True)
+            data = load_asset('phrase_data')
         else:
             data = self.phrase_data
-        melody = data['melody']
-        acc = data['acc']
-        chord = data['chord']
         if not self.edge_weights:
-            edge_weights = np.load(DATA_DIR + '/edge_weights_0714.npz', allow_pickle=True)
+            edge_weights = load_asset('edge_weights')
         else:
             edge_weights = self.edge_weights
 
@@ -74,17 +71,8 @@ class AccoMontage:
             melody_queries.append(segment)  # melody queries: list of T16*142, segmented by phrases
 
         print('Processing Reference Phrases')
-        acc_pool = {}
-        (mel, acc_, chord_, song_reference) = find_by_length(melody, acc, chord, 8)
-        acc_pool[8] = (mel, acc_, chord_, song_reference)
-
-        (mel, acc_, chord_, song_reference) = find_by_length(melody, acc, chord, 4)
-        acc_pool[4] = (mel, acc_, chord_, song_reference)
-
-        (mel, acc_, chord_, song_reference) = find_by_length(melody, acc, chord, 6)
-        acc_pool[6] = (mel, acc_, chord_, song_reference)
-
-        texture_filter = get_texture_filter(acc_pool)
+        acc_pool, texture_filter, features = get_reference_pools(data)
+        song_index = load_asset('song_index') if self.song_index is None else as_song_index(self.song_index)
 
         print('Phrase Selection Begins:\n\t', len(query_phrases), 'phrases in query lead sheet;\n\t', 'Refer to',
               SPOTLIGHT,
@@ -96,24 +84,23 @@ class AccoMontage:
             edge_weights,
             texture_filter,
             filter_id=PREFILTER,
-            spotlights=ref_spotlight(SPOTLIGHT, song_index=self.song_index))
+            spotlights=ref_spotlight(SPOTLIGHT, song_index=song_index),
+            features=features)
 
         path = phrase_indice[0]
         shift = chord_shift[0]
         reference_set = []
-        df = pd.read_excel(DATA_DIR + "/POP909 4bin quntization/four_beat_song_index.xlsx") \
-            if self.song_index is None else self.song_index
         for idx_phrase, phrase in enumerate(query_phrases):
             phrase_len = phrase[1]
             song_ref = acc_pool[phrase_len][-1]
             idx_song = song_ref[path[idx_phrase][0]][0]
-            song_name = df.iloc[idx_song][1]
+            song_name = song_index.name(idx_song)
             reference_set.append((idx_song, song_name))
         print('Reference chosen:', reference_set)
         print('Pitch Transposition (Fit by Model):', shift)
 
         print('Generating...')
-        midi = render_acc_new(chord_table, acc_pool)
+        midi = render_acc_new(chord_table, acc_pool, state_dict=self.state_dict)
         if self.original_tempo != 120:
             for ins in midi.instruments:
                 for note in ins.notes:
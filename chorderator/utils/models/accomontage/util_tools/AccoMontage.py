@@ -1,13 +1,13 @@
 import numpy as np
 import pretty_midi
 from tqdm import tqdm
-import pandas as pd
 import torch
 import os
 
 from .format_converter import accompany_matrix2data, chord_matrix2data
 from ..models.ptvae import PtvaeDecoder
 from .....settings import ACCOMONTAGE_DATA_DIR
+from .....utils.assets import as_song_index, load_asset
 from .acc_utils import melodySplit, chordSplit, computeTIV, chord_shift, cosine, cosine_rhy, accomapnimentGeneration
 from ..models.model import DisentangleVAE
 
@@ -36,20 +36,37 @@ def find_by_length(melody_data, acc_data, chord_data, length):
     return np.array(melody_record), np.array(acc_record), np.array(chord_record), song_reference
 
 
-def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=None, filter_id=None, spotlights=None):
+def reference_features(mel, chord):
+    """
+    Query-independent features of one reference pool that dp_search compares every query against.
+    """
+    rhy_set = np.concatenate((np.sum(mel[:, :, :128], axis=-1, keepdims=True), mel[:, :, 128: 130]), axis=-1)
+    chord_set, num_total, shift_const = chord_shift(chord)
+    return {
+        'rhy_set': rhy_set,
+        'chord_set_TIV': computeTIV(chord_set),
+        'shift_const': np.array(shift_const),
+        'melody_flat': np.argmax(mel, axis=-1),
+    }
+
+
+def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=None, filter_id=None, spotlights=None,
+              features=None):
+    # features: {length: reference_features(...)}, computed here for every length it does not cover
+    features = {} if features is None else features
     print('Searching for Phrase 1')
     query_length = [query_phrases[i].shape[0] // 16 for i in range(len(query_phrases))]
     mel, acc, chord, song_ref = acc_pool[query_length[0]]
-    mel_set = mel
-    rhy_set = np.concatenate((np.sum(mel_set[:, :, :128], axis=-1, keepdims=True), mel_set[:, :, 128: 130]), axis=-1)
+    if query_length[0] not in features:
+        features[query_length[0]] = reference_features(mel, chord)
+    rhy_set = features[query_length[0]]['rhy_set']
     query_rhy = np.concatenate(
         (np.sum(query_phrases[0][:, : 128], axis=-1, keepdims=True), query_phrases[0][:, 128: 130]), axis=-1)[
                 np.newaxis, :, :]
     rhythm_result = cosine_rhy(query_rhy, rhy_set)
 
-    chord_set = chord
-    chord_set, num_total, shift_const = chord_shift(chord_set)
-    chord_set_TIV = computeTIV(chord_set)
+    chord_set_TIV = features[query_length[0]]['chord_set_TIV']
+    shift_const = features[query_length[0]]['shift_const'].tolist()
     query_chord = query_phrases[0][:, 130:][::4]
     query_chord_TIV = computeTIV(query_chord)[np.newaxis, :, :]
     chord_score, arg_chord = cosine(query_chord_TIV, chord_set_TIV)
@@ -67,7 +84,7 @@ def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=N
     # print(np.argmax(score), np.max(score), score[0])
     path = [[(i, score[i])] for i in range(acc.shape[0])]
     shift = [[shift_const[i]] for i in arg_chord]
-    melody_record = np.argmax(mel_set, axis=-1)
+    melody_record = features[query_length[0]]['melody_flat']
     record = []
     if len(query_length) == 1:
         return path, shift
@@ -77,7 +94,7 @@ def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=N
         mel, acc, chord, song_ref = acc_pool[query_length[i]]
 
         weight_key = 'l' + str(query_length[i - 1]) + str(query_length[i])
-        contras_result = edge_weights[weight_key]
+        contras_result = np.array(edge_weights[weight_key])  # modified in place below, bundle arrays are read-only
         # contras_result = (contras_result - 0.9) * 10   #rescale contrastive result if necessary
         # print(np.sort(contras_result[np.random.randint(2000)][-20:]))
         if query_length[i - 1] == query_length[i]:
@@ -97,16 +114,15 @@ def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=N
                     if ref_item[0] == spot_idx:
                         contras_result[:, ref_idx] += 1
 
-        mel_set = mel
-        rhy_set = np.concatenate((np.sum(mel_set[:, :, :128], axis=-1, keepdims=True), mel_set[:, :, 128: 130]),
-                                 axis=-1)
+        if query_length[i] not in features:
+            features[query_length[i]] = reference_features(mel, chord)
+        rhy_set = features[query_length[i]]['rhy_set']
         query_rhy = np.concatenate(
             (np.sum(query_phrases[i][:, : 128], axis=-1, keepdims=True), query_phrases[i][:, 128: 130]), axis=-1)[
                     np.newaxis, :, :]
         rhythm_result = cosine_rhy(query_rhy, rhy_set)
-        chord_set = chord
-        chord_set, num_total, shift_const = chord_shift(chord_set)
-        chord_set_TIV = computeTIV(chord_set)
+        chord_set_TIV = features[query_length[i]]['chord_set_TIV']
+        shift_const = features[query_length[i]]['shift_const'].tolist()
         query_chord = query_phrases[i][:, 130:][::4]
         query_chord_TIV = computeTIV(query_chord)[np.newaxis, :, :]
         chord_score, arg_chord = cosine(query_chord_TIV, chord_set_TIV)
@@ -119,7 +135,7 @@ def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=N
         score_this_layer = .7 * contras_result + .3 * np.tile(sim_this_layer[np.newaxis, :],
                                                               (contras_result.shape[0], 1)) + np.tile(
             score[:, np.newaxis], (1, contras_result.shape[1]))
-        melody_flat = np.argmax(mel_set, axis=-1)
+        melody_flat = features[query_length[i]]['melody_flat']
         if seg_query[i] == seg_query[i - 1]:
             melody_pre = melody_record
             matrix = np.matmul(melody_pre, np.transpose(melody_flat, (1, 0))) / (
@@ -160,7 +176,7 @@ def dp_search(query_phrases, seg_query, acc_pool, edge_weights, texture_filter=N
     return [path[arg[i]] for i in range(topk)], [shift[arg[i]] for i in range(topk)]
 
 
-def render_acc_new(chord_table, acc_pool):
+def render_acc_new(chord_table, acc_pool, state_dict=None):
     length = 8
     idx = 144  # 改 reference
     acc_emsemble = acc_pool[length][1][idx]
@@ -168,13 +184,15 @@ def render_acc_new(chord_table, acc_pool):
     chord_table_split = chordSplit(chord_table, 8, 8)
     if torch.cuda.is_available():
         model = DisentangleVAE.init_model(torch.device('cuda')).cuda()
-        checkpoint = torch.load(DATA_DIR + '/model_master_final.pt', map_location=torch.device('cuda'))
+        checkpoint = torch.load(DATA_DIR + '/model_master_final.pt', map_location=torch.device('cuda')) \
+            if state_dict is None else state_dict
         model.load_state_dict(checkpoint)
         pr_matrix = torch.from_numpy(acc_emsemble).float().cuda()
         gt_chord = torch.from_numpy(chord_table_split).float().cuda()
     else:
         model = DisentangleVAE.init_model(torch.device('cpu'))
-        checkpoint = torch.load(DATA_DIR + '/model_master_final.pt', map_location=torch.device('cpu'))
+        checkpoint = torch.load(DATA_DIR + '/model_master_final.pt', map_location=torch.device('cpu')) \
+            if state_dict is None else state_dict
         model.load_state_dict(checkpoint)
         pr_matrix = torch.from_numpy(acc_emsemble).float()
         gt_chord = torch.from_numpy(chord_table_split).float()
@@ -254,18 +272,12 @@ def render_acc(pianoRoll, chord_table, query_seg, indices, shifts, acc_pool, sta
 
 
 def ref_spotlight(ref_name_list, song_index=None):
-    df = pd.read_excel(DATA_DIR + "/POP909 4bin quntization/four_beat_song_index.xlsx") \
-        if song_index is None else song_index
+    song_index = load_asset('song_index') if song_index is None else as_song_index(song_index)
     check_idx = []
     for name in ref_name_list:
-        line = df[df.name == name]
-        if not line.empty:
-            check_idx.append(line.index)  # read by pd, neglect first row, index starts from 0.
-    # print(check_idx)
+        check_idx += song_index.rows_by_name(name)  # rows start from 0, same as song indices in phrase data
     for name in ref_name_list:
-        line = df[df.artist == name]
-        if not line.empty:
-            check_idx += list(line.index)  # read by pd, neglect first row, index starts from 0
+        check_idx += song_index.rows_by_artist(name)
     return check_idx
 
 
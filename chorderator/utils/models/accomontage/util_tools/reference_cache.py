@@ -0,0 +1,168 @@
+"""
+On-disk cache of the query-independent part of the texture search: the
+reference pools find_by_length builds for each phrase length, their texture
+filters, and the features dp_search compares queries against. None of these
+depend on the query, so they are computed once per version of the phrase
+data, saved as .npy files under TEXTURE_CACHE_DIR/<hash>/ and
+memory-mapped read-only on later runs.
+
+The hash is the SHA-1 of phrase_data0714.npz. When the phrase data comes
+from a compiled bundle, the hash recorded in the bundle at compile time is
+used instead; the npz does not need to be present. The bundle also holds the
+reference pools themselves (PhraseData.pool), so then they are sliced out
+of it and only the filters and features are cached.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .AccoMontage import find_by_length, get_texture_filter, reference_features
+from .....settings import TEXTURE_CACHE_DIR, accomontage_storage
+from .....utils.assets import PhraseData, file_sha1
+from .....utils.utils import Logging
+
+CACHE_VERSION = 1
+POOL_LENGTHS = PhraseData.pool_lengths
+POOL_FIELDS = ['mel', 'acc', 'chord', 'song_reference']
+FEATURE_FIELDS = ['rhy_set', 'chord_set_TIV', 'shift_const', 'melody_flat']
+
+_HASH_STAMPS = TEXTURE_CACHE_DIR + 'hashes.json'
+
+
+def _stamped_sha1(path):
+    # hashing the npz reads all of it, so remember the result per (size, mtime)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    try:
+        with open(_HASH_STAMPS) as file:
+            stamps = json.load(file)
+    except (OSError, ValueError):
+        stamps = {}
+    if path in stamps and stamps[path]['stamp'] == stamp:
+        return stamps[path]['sha1']
+    sha1 = file_sha1(path)
+    stamps[path] = {'stamp': stamp, 'sha1': sha1}
+    try:
+        os.makedirs(TEXTURE_CACHE_DIR, exist_ok=True)
+        with open(_HASH_STAMPS + '.tmp', 'w') as file:
+            json.dump(stamps, file)
+        os.replace(_HASH_STAMPS + '.tmp', _HASH_STAMPS)
+    except OSError:
+        pass
+    return sha1
+
+
+def _is_default_npz(phrase_data):
+    # phrase data np.load-ed from phrase_data0714.npz itself, as load_asset does without a bundle
+    fid = getattr(phrase_data, 'fid', None)
+    path = getattr(fid, 'name', None)
+    return isinstance(path, str) and os.path.abspath(path) == os.path.abspath(accomontage_storage['phrase_data'])
+
+
+def reference_key(phrase_data=None):
+    """
+    Hash identifying the phrase data, or None if it cannot be told (nothing is cached then).
+    Phrase data from anywhere but the bundle or the default npz is not cached, since the file
+    hash would not describe it.
+    """
+    meta = getattr(phrase_data, 'meta', None)
+    if meta is not None and 'source_sha1' in meta:
+        return meta['source_sha1']
+    if phrase_data is not None and not _is_default_npz(phrase_data):
+        return None
+    path = accomontage_storage['phrase_data']
+    if os.path.exists(path):
+        return _stamped_sha1(path)
+    return None
+
+
+def _has_pools(phrase_data):
+    return isinstance(phrase_data, PhraseData)
+
+
+def _entry_dir(key, with_pools):
+    return TEXTURE_CACHE_DIR + 'texture_v{}_{}{}/'.format(CACHE_VERSION, key, '' if with_pools else '_features')
+
+
+def _file_name(field, length):
+    return '{}_{}.npy'.format(field, length)
+
+
+def build_reference_pools(phrase_data):
+    acc_pool = {}
+    for length in POOL_LENGTHS:
+        if _has_pools(phrase_data):
+            acc_pool[length] = phrase_data.pool(length)
+        else:
+            acc_pool[length] = find_by_length(phrase_data['melody'], phrase_data['acc'], phrase_data['chord'], length)
+    texture_filter = get_texture_filter(acc_pool)
+    features = {length: reference_features(acc_pool[length][0], acc_pool[length][2]) for length in POOL_LENGTHS}
+    return acc_pool, texture_filter, features
+
+
+def save_reference_pools(key, acc_pool, texture_filter, features, with_pools=True):
+    entry = _entry_dir(key, with_pools)
+    tmp = entry[:-1] + '.tmp.{}/'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        for length in POOL_LENGTHS:
+            arrays = {
+                'hd_bins': np.stack(texture_filter[length][0]),
+                'vd_bins': np.stack(texture_filter[length][1]),
+            }
+            if with_pools:
+                mel, acc, chord, song_reference = acc_pool[length]
+                arrays.update(mel=mel, acc=acc, chord=chord,
+                              song_reference=np.array(song_reference, dtype=np.int64).reshape(-1, 2))
+            arrays.update(features[length])
+            for field, array in arrays.items():
+                np.save(tmp + _file_name(field, length), np.ascontiguousarray(array))
+        if os.path.exists(entry):
+            shutil.rmtree(tmp)
+        else:
+            os.replace(tmp, entry)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def load_reference_pools(key, phrase_data=None):
+    with_pools = not _has_pools(phrase_data)
+    entry = _entry_dir(key, with_pools)
+    if not os.path.isdir(entry):
+        return None
+    acc_pool, texture_filter, features = {}, {}, {}
+    try:
+        for length in POOL_LENGTHS:
+            load = lambda field: np.load(entry + _file_name(field, length), mmap_mode='r')
+            if with_pools:
+                acc_pool[length] = tuple(load(field) for field in POOL_FIELDS)
+            else:
+                acc_pool[length] = phrase_data.pool(length)
+            texture_filter[length] = (load('hd_bins'), load('vd_bins'))
+            features[length] = {field: load(field) for field in FEATURE_FIELDS}
+    except (OSError, ValueError) as e:
+        Logging.warning('texture cache {} is unreadable ({}), rebuilding it'.format(entry, e))
+        return None
+    return acc_pool, texture_filter, features
+
+
+def get_reference_pools(phrase_data):
+    """
+    Returns (acc_pool, texture_filter, features), from the cache if possible.
+    phrase_data is only read on a cache miss.
+    """
+    key = reference_key(phrase_data)
+    if key is not None:
+        cached = load_reference_pools(key, phrase_data)
+        if cached is not None:
+            return cached
+    pools = build_reference_pools(phrase_data)
+    if key is not None:
+        try:
+            save_reference_pools(key, *pools, with_pools=not _has_pools(phrase_data))
+        except OSError as e:
+            Logging.warning('cannot write texture cache to {} ({})'.format(TEXTURE_CACHE_DIR, e))
+    return pools
@@ -2,7 +2,10 @@ import pretty_midi
 
 from ..chords.ChordProgression import read_progressions
 from .excp import handle_exception
-from .utils import Logging, pickle_read, combine_ins
+from .assets import load_asset
+from .solution_cache import duplicate_id_map, from_duplicate_ids, solution_cache, solution_key, to_duplicate_ids, \
+    uses_default_data
+from .utils import Logging, combine_ins, read_midi
 
 
 class Pipeline:
@@ -13,6 +16,8 @@ class Pipeline:
         self.final_output = None
         self.final_output_log = None
         self.chord_gen_output = None
+        self.progression_alternatives = []
+        self.main_processor = None
         self.state = 0
         self.pipeline = pipeline
         if len(pipeline) < 3:
@@ -39,7 +44,7 @@ class Pipeline:
             self.state = 4
             if not cut_in_arg:
                 handle_exception(500)
-            chord_gen_midi = pretty_midi.PrettyMIDI(cut_in_arg)
+            chord_gen_midi = read_midi(cut_in_arg)
             self.chord_gen_output = chord_gen_midi.instruments[1]
             self.melo = chord_gen_midi.instruments[0]
             self.meta['tempo'] = chord_gen_midi.get_tempo_changes()[1][0]
@@ -50,7 +55,8 @@ class Pipeline:
             Logging.warning('Pre-process done!')
             self.state = 2
             Logging.warning('Solving...')
-            progression_list = self.__main_model(splited_melo, self.meta)
+            progression_list = self.__main_model(splited_melo, self.meta, kwargs.get('k_best', 1),
+                                                 kwargs.get('main_processor'), kwargs.get('cache', {}))
             Logging.warning('Solved!')
             self.state = 3
             Logging.warning('Post-processing...')
@@ -70,23 +76,59 @@ class Pipeline:
         processor = self.pipeline[0](midi_path, kwargs['phrase'], kwargs['meta'], kwargs['note_shift'])
         return processor.get()
 
-    def __main_model(self, splited_melo, meta):
-        templates = read_progressions('rep')
+    def __main_model(self, splited_melo, meta, k_best=1, previous=None, cache=None):
+        cache = cache if cache is not None else {}
+        templates = cache['rep'] if 'rep' in cache else read_progressions('rep')
         meta['metre'] = meta['meter']
         print([len(i) for i in splited_melo])
-        processor = self.pipeline[1](splited_melo, meta, templates)
-        processor.solve()
-        return processor.get()
 
-    def __postprocess(self, progression_list, **kwargs):
-        if 'templates' not in kwargs:
-            templates = read_progressions('dict')
+        # the melody is in scale degrees here, so a solution is reused for any tonic
+        key = solution_key(splited_melo, meta, self.pipeline[1], k_best) if uses_default_data(cache) else None
+        solution = solution_cache.get(key) if key is not None else None
+        if solution is not None:
+            Logging.info('Chord progression taken from the solution cache')
+            template_sets = cache.get('template_sets')
+            by_id = template_sets.by_duplicate_id() if getattr(template_sets, 'library', None) is templates \
+                else duplicate_id_map(templates)
+            alternatives = [(from_duplicate_ids(ids, by_id), score) for ids, score in solution]
         else:
-            templates = kwargs['templates']
-        if 'lib' not in kwargs:
-            lib = pickle_read('lib')
-        else:
-            lib = kwargs['lib']
+            if self.__can_update(previous, meta, k_best, templates, cache):
+                # only the phrases from the first changed one on are solved again
+                processor = previous
+                processor.update(splited_melo, meta)
+            else:
+                # template sets and transition scores shared through the cache, so a new DP costs nothing
+                processor = self.pipeline[1](splited_melo, meta, templates, k_best=k_best,
+                                             template_sets=cache.get('template_sets'),
+                                             transition_dict=cache.get('trans'))
+            processor.solve()
+            if previous is not None and previous is not processor and hasattr(previous, 'close'):
+                previous.close()  # replaced, its worker processes are not needed any more
+            self.main_processor = processor
+            alternatives = processor.get_alternatives()
+            if key is not None:
+                solution_cache.put(key, [(to_duplicate_ids(progressions), score) for progressions, score in alternatives])
+        if k_best > 1:
+            self.progression_alternatives = alternatives
+        return alternatives[0][0]
+
+    def __can_update(self, previous, meta, k_best, templates, cache):
+        # same model, mode and k_best, solving against the same templates, filters and transition scores
+        model = self.pipeline[1]
+        if type(previous) is not model or not hasattr(previous, 'update'):
+            return False
+        filters = (tuple(sorted(model.SOLVE_ONLY_WITH_THESE_PROGRESSIONS)),
+                   tuple(sorted(model.SOLVE_WITHOUT_THESE_PROGRESSIONS)))
+        template_sets, transition_dict = cache.get('template_sets'), cache.get('trans')
+        return previous.melo_meta['mode'] == meta['mode'] and getattr(previous, 'k_best', 1) == k_best \
+            and previous.progression_library is templates and previous.template_filters == filters \
+            and (template_sets is None or template_sets.get(meta['mode'], *filters) is previous.template_set) \
+            and (transition_dict is None or previous.transition_dict is transition_dict)
+
+    def __postprocess(self, progression_list, **kwargs):
+        cache = kwargs['cache'] if 'cache' in kwargs else {}
+        templates = cache['dict'] if 'dict' in cache else read_progressions('dict')
+        lib = cache['lib'] if 'lib' in cache else load_asset('lib')
         processor = self.pipeline[2](progression_list,
                                      templates,
                                      lib,
@@ -105,11 +147,13 @@ class Pipeline:
         new_chord = self.__to_tempo(output, original_tempo, 120)
         midi = combine_ins(new_melo, new_chord, init_tempo=120)
         if do_add_textures:
+            # texture data is only resolved here, so the chord stage never waits for it
+            cache = kwargs['cache'] if 'cache' in kwargs else {}
             processor = self.pipeline[3](midi=midi, segmentation=kwargs['segmentation'], note_shift=kwargs['note_shift'],
                                          spotlight=kwargs['texture_spotlight'],
-                                         prefilter=kwargs['texture_prefilter'], state_dict=kwargs['state_dict'],
-                                         phrase_data=kwargs['phrase_data'], edge_weights=kwargs['edge_weights'],
-                                         song_index=kwargs['song_index'], original_tempo=original_tempo)
+                                         prefilter=kwargs['texture_prefilter'], state_dict=cache.get('state_dict'),
+                                         phrase_data=cache.get('phrase_data'), edge_weights=cache.get('edge_weights'),
+                                         song_index=cache.get('song_index'), original_tempo=original_tempo)
             processor.solve()
             return processor.get()
         else:
@@ -0,0 +1,130 @@
+"""
+Pre-fork serving mode.
+
+The parent process loads all reference data once, moves it out of the
+garbage collector's reach with ``gc.freeze()`` and forks the workers, so the
+workers share the parent's pages copy-on-write instead of each holding
+their own copy. Data read from compiled bundles (see utils/assets.py) is
+memory-mapped read-only and is never copied at all.
+
+gc.freeze only keeps the collector off those pages. A worker that uses a
+Python object (a template, a Chord) still updates its reference count, so
+the pages holding the objects it touches get copied into that worker.
+Arrays and memory maps are shared as long as they are only read. What is
+saved is therefore the load time and the array data, not the object
+headers; benchmarks/bench_prefork_memory.py measures it.
+
+Workers are forked once and serve requests until the pool closes
+(maxtasksperchild=None). A worker that dies is replaced by a fork of the
+parent at that time, which is no longer frozen, so its garbage collector
+may touch, and copy, the shared objects.
+
+    pool = PreforkPool(workers=4)
+    result = pool.generate({'melody': 'melody.mid', 'meta': {'tonic': 'C'}, 'segmentation': 'A8B8'})
+    gen, chord_gen = result.get()
+"""
+import gc
+
+from .forking import fork_pool
+from .utils import Logging
+from ..core import Core
+
+# set in the parent right before forking, inherited by the workers
+_shared_cache = None
+
+_setters = {
+    'output_style': 'set_output_style',
+    'texture_prefilter': 'set_texture_prefilter',
+    'texture_spotlight': 'set_texture_spotlight',
+    'note_shift': 'set_note_shift',
+}
+
+
+def worker_cache():
+    """the Core.cache the workers share (in the parent: the one of the last pool created)"""
+    return _shared_cache
+
+
+def _init_worker():
+    gc.enable()
+
+
+def _worker_core(config):
+    core = Core()
+    core.cache = _shared_cache
+    core.set_melody(config['melody'])
+    core.set_meta(**config['meta'])
+    core.set_segmentation(config['segmentation'])
+    for key, setter in _setters.items():
+        if key in config:
+            getattr(core, setter)(config[key])
+    return core
+
+
+def _generate(config, kwargs):
+    return _worker_core(config).generate(**kwargs)
+
+
+def _generate_save(config, output_name, kwargs):
+    _worker_core(config).generate_save(output_name, **kwargs)
+    return output_name
+
+
+class PreforkPool:
+
+    def __init__(self, workers=2, cache=None, preload=None):
+        """
+        cache: entries for Core.set_cache. preload: names of the Core.cache entries loaded before
+        forking (default: all of them), any other entry is loaded by each worker on first use.
+        """
+        global _shared_cache
+        core = Core()
+        if cache is not None:
+            core.set_cache(**cache)
+        _shared_cache = core.cache.load(preload)
+        # import the models (and torch with them) once here rather than in every worker
+        main_model = core.get_pipeline_models()[1]
+        # and resolve the DP templates of both modes
+        for mode in Core.registered['meta.mode']:
+            _shared_cache['template_sets'].get(mode, main_model.SOLVE_ONLY_WITH_THESE_PROGRESSIONS,
+                                               main_model.SOLVE_WITHOUT_THESE_PROGRESSIONS).load()
+
+        # keep the collector from touching (and so copying) the shared objects in the workers
+        gc.disable()
+        gc.collect()
+        gc.freeze()
+        Logging.info('forking {} workers'.format(workers))
+        # no maxtasksperchild: a replacement worker would be forked from the unfrozen parent
+        self._pool = fork_pool(workers, 'Pre-forked workers', initializer=_init_worker, maxtasksperchild=None)
+        gc.unfreeze()
+        gc.enable()
+        if self._pool is None:
+            raise RuntimeError('Pre-fork mode cannot fork workers here, see the warning above')
+
+    def generate(self, config, **kwargs):
+        """
+        config: dict with 'melody', 'meta' (kwargs of set_meta), 'segmentation' and
+        optionally 'output_style', 'texture_prefilter', 'texture_spotlight', 'note_shift'.
+        Returns an AsyncResult of Core.generate(**kwargs).
+        """
+        return self._pool.apply_async(_generate, (config, kwargs))
+
+    def generate_save(self, config, output_name, **kwargs):
+        return self._pool.apply_async(_generate_save, (config, output_name, kwargs))
+
+    def apply_async(self, func, args=()):
+        """run func(*args) in a worker; it can read the shared data through worker_cache()"""
+        return self._pool.apply_async(func, args)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,4 +1,13 @@
+from ...chords.RootSequenceIndex import RootSequenceIndex, transition_chord_sequences
+
 transition_dict = {}
+_index = [None, None]  # (templates, RootSequenceIndex) of the last templates scored against
+
+
+def _root_sequence_index(templates):
+    if _index[0] is not templates:
+        _index[:] = [templates, RootSequenceIndex(templates)]
+    return _index[1]
 
 
 def transition_score(cur_template, prev_template, templates):
@@ -6,54 +15,11 @@ def transition_score(cur_template, prev_template, templates):
     if tuple(transition_bars) in transition_dict:
         return transition_dict[tuple(transition_bars)]
 
-    chord_sequence_prev = [prev_template.progression[-1][0]]
-    for i in prev_template.progression[-1]:
-        chord_sequence_prev.append(i) if i != chord_sequence_prev[-1] else None
-
-    chord_sequence_cur = [cur_template.progression[-1][0]]
-    for i in cur_template.progression[0]:
-        chord_sequence_cur.append(i) if i != chord_sequence_cur[-1] else None
-
-    prev_part = [chord_sequence_prev[i:] for i in range(len(chord_sequence_prev))]
-    cur_part = [chord_sequence_cur[:i + 1] for i in range(len(chord_sequence_cur))]
-
     # chord_sequences contains all sequences of chord that contains the transition two chords in the transition bars
-
-    chord_sequences_dup = []
-    for i in range(len(prev_part)):
-        for j in range(len(cur_part)):
-            chord_sequences_dup.append(prev_part[i] + cur_part[j])
-
-    chord_sequences = []
-    for c in chord_sequences_dup:
-        new = [c[0]]
-        for i in c:
-            new.append(i) if i != new[-1] else None
-        chord_sequences.append(new)
+    chord_sequences = transition_chord_sequences(prev_template, cur_template)
 
     # search the number of occurrence in the template space
-    score = 0
-    for template in templates:
-        unique_temp = [template.get(only_root=True, flattened=True)[0]]
-        for i in template.get(only_root=True, flattened=True):
-            unique_temp.append(i) if i != unique_temp[-1] else None
-        for chord_sequence in chord_sequences:
-            # if chord_sequence in unique_temp:
-            #     score += 1
-            if len(chord_sequence) > len(unique_temp):
-                continue
-            all_slices = [unique_temp[i:i + len(chord_sequence)]
-                          for i in range(len(unique_temp) - len(chord_sequence) + 1)]
-            new = []
-            for slc in all_slices:
-                if len(slc) != 1:
-                    new.append(slc)
-            all_slices = new
-            # print(all_slices, chord_sequence)
-            for slc in all_slices:
-                if slc == chord_sequence:
-                    score += 1
-                    break
+    score = _root_sequence_index(templates).score(chord_sequences)
 
     # new_score = log_{max_score}(score)
 
@@ -0,0 +1,144 @@
+"""
+Cache of chord-stage solutions across requests.
+
+The main model works on scale degrees (PreProcessor converts the melody
+relative to its tonic), so its solution does not depend on the key: the
+same melody transposed to another tonic gives the same progressions, and
+only post-processing, which places them in the key, differs. Solutions are
+kept as duplicate-id lists in a bounded LRU and, when SOLUTION_CACHE_DIR is
+set, as small JSON files that survive restarts.
+
+The key is a hash of the degree sequences of the phrases, their positions,
+the mode, the model and its progression filters, k_best, and the versions
+of the progression, template and transition data. Solutions are only cached
+when the solver uses the default data (see uses_default_data).
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .assets import LazyCache, open_bundle
+from .utils import Logging
+from ..settings import SOLUTION_CACHE_DIR, SOLUTION_CACHE_SIZE, static_storage
+
+CACHE_VERSION = 1
+SOLVER_DATA = ['rep', 'trans', 'concat_major', 'concat_minor']
+SOLVER_CACHE_ENTRIES = ['rep', 'trans', 'template_sets']  # Core.cache entries the solver reads
+
+_data_version = []
+
+
+def _solver_data_version():
+    # computed once per process: bundle hashes, or size and mtime of the source files
+    if not _data_version:
+        version = {}
+        for name in SOLVER_DATA:
+            bundle = open_bundle(name)
+            if bundle is not None:
+                version[name] = bundle.meta.get('source_sha1')
+            elif os.path.exists(static_storage[name]):
+                stat = os.stat(static_storage[name])
+                version[name] = [stat.st_size, stat.st_mtime_ns]
+        _data_version.append(version)
+    return _data_version[0]
+
+
+def uses_default_data(cache):
+    """
+    True if the solver reads the default progression library and transition scores, the only data
+    the key has a version of. Solutions for data passed through Core.set_cache are not cached.
+    """
+    if isinstance(cache, LazyCache):
+        return not any(cache.is_overridden(name) for name in SOLVER_CACHE_ENTRIES)
+    return not any(name in cache for name in SOLVER_CACHE_ENTRIES)
+
+
+def solution_key(splited_melo, meta, model, k_best=1):
+    key = {
+        'version': CACHE_VERSION,
+        'melody': [[float(note) for note in phrase] for phrase in splited_melo],
+        'pos': list(meta['pos']),
+        'mode': 'major' if meta['mode'] in ['maj', 'M'] else 'minor',
+        'model': model.__name__,
+        'only': sorted(getattr(model, 'SOLVE_ONLY_WITH_THESE_PROGRESSIONS', [])),
+        'without': sorted(getattr(model, 'SOLVE_WITHOUT_THESE_PROGRESSIONS', [])),
+        'k_best': k_best,
+        'data': _solver_data_version(),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def to_duplicate_ids(progression_list):
+    return [[int(progression.progression_class['duplicate-id']) for progression in phrase]
+            for phrase in progression_list]
+
+
+def duplicate_id_map(templates):
+    return {temp.progression_class['duplicate-id']: temp for temp in templates}
+
+
+def from_duplicate_ids(ids, by_duplicate_id):
+    """by_duplicate_id: {duplicate-id: progression}, see duplicate_id_map and TemplateSets.by_duplicate_id"""
+    return [[by_duplicate_id[i] for i in phrase] for phrase in ids]
+
+
+class SolutionCache:
+    """
+    LRU of solutions, each a list of (duplicate-id lists, score) alternatives, best first.
+    """
+
+    def __init__(self, size=SOLUTION_CACHE_SIZE, directory=SOLUTION_CACHE_DIR):
+        self.size = size
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not self.directory or not os.path.exists(self.__path(key)):
+            return None
+        try:
+            with open(self.__path(key)) as file:
+                solution = [(ids, score) for ids, score in json.load(file)]
+        except (OSError, ValueError) as e:
+            Logging.warning('ignoring cached solution {} ({})'.format(self.__path(key), e))
+            return None
+        self.__remember(key, solution)
+        return solution
+
+    def put(self, key, solution):
+        self.__remember(key, solution)
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.__path(key) + '.tmp.{}'.format(os.getpid())
+            with open(tmp, 'w') as file:
+                json.dump(solution, file)
+            os.replace(tmp, self.__path(key))
+        except (OSError, TypeError) as e:
+            Logging.warning('cannot write cached solution to {} ({})'.format(self.directory, e))
+
+    def __remember(self, key, solution):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = solution
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+solution_cache = SolutionCache()
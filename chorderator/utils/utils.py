@@ -1,6 +1,9 @@
+import bisect
+import io
 import logging
 import pickle
 import random
+import threading
 import time
 import os
 import numpy as np
@@ -13,15 +16,19 @@ from ..utils import structured
 from ..utils import string
 from ..settings import static_storage
 
-try:
-    from midi2audio import FluidSynth
-except ImportError as e:
-    FluidSynth = None
+_fluid_synth = []
 
-fs_exist = True
-if FluidSynth is None:
-    fs_exist = False
-    warnings.warn('Could not import FluidSynth, audio formats writing disabled')
+
+def get_fluid_synth():
+    # probed on first use instead of at import, most runs never write audio
+    if not _fluid_synth:
+        try:
+            from midi2audio import FluidSynth
+        except ImportError as e:
+            FluidSynth = None
+            warnings.warn('Could not import FluidSynth, audio formats writing disabled')
+        _fluid_synth.append(FluidSynth)
+    return _fluid_synth[0]
 
 
 def pickle_read(path):
@@ -90,6 +97,51 @@ def combine_ins(*kargs: Instrument, init_tempo=120) -> PrettyMIDI:
     return midi
 
 
+def note_array_to_ins(notes, program=0) -> Instrument:
+    """rows of (start, end, pitch) or (start, end, pitch, velocity), times in seconds"""
+    notes = np.asarray(notes, dtype=np.float64).reshape(len(notes), -1)
+    if notes.shape[1] not in (3, 4):
+        raise ValueError('a note array needs 3 or 4 columns (start, end, pitch[, velocity]), got {}'
+                         .format(notes.shape[1]))
+    velocities = notes[:, 3] if notes.shape[1] == 4 else np.full(len(notes), 80)
+    ins = Instrument(program=program)
+    for (start, end, pitch), velocity in zip(notes[:, :3].tolist(), velocities.tolist()):
+        ins.notes.append(Note(pitch=int(pitch), velocity=int(velocity), start=start, end=end))
+    return ins
+
+
+def read_midi(midi) -> PrettyMIDI:
+    """
+    midi can be a path, the bytes of a MIDI file, a binary file-like object, a PrettyMIDI,
+    an Instrument or a note array (see note_array_to_ins), so uploads need no temporary file.
+    """
+    if isinstance(midi, PrettyMIDI):
+        return midi
+    if isinstance(midi, (bytes, bytearray, memoryview)):
+        return PrettyMIDI(io.BytesIO(midi))
+    if isinstance(midi, (str, os.PathLike)):
+        return PrettyMIDI(os.fspath(midi))
+    if hasattr(midi, 'read'):
+        return PrettyMIDI(midi)
+    return combine_ins(midi if isinstance(midi, Instrument) else note_array_to_ins(midi))
+
+
+def segmentation_to_phrase(s):
+    """'A8B8\\n' -> [1, 9], the first bar of each phrase; the last phrase runs to the end"""
+    phrase = [1]
+    memo = ''
+    for i in s:
+        if i == '\\':
+            return phrase
+        if not i.isdigit():
+            if memo != '':
+                phrase.append(phrase[-1] + int(memo))
+                memo = ''
+        else:
+            memo += i
+    return phrase[:-1]
+
+
 def midi_shift(midi: PrettyMIDI, shift, tempo=120):
     unit_length = (60 / tempo) / 4
     for i in midi.instruments:
@@ -251,7 +303,8 @@ def listen_pitches(midi_pitch: list, time, instrument=0):
 
 
 def listen(midi: PrettyMIDI, path=None, out=None):
-    if not fs_exist:
+    FluidSynth = get_fluid_synth()
+    if FluidSynth is None:
         return False
     if not path:
         path = string.STATIC_DIR + "audio/"
@@ -404,6 +457,51 @@ class PathGenerator:
             return all_path
 
 
+class MelodyStore:
+    """
+    POP909 phrase melodies (phrase_split_data/melodies.pk), read once per process
+    and shared by every MIDILoader(files='POP909'). Phrases are looked up by name
+    through a dict, and by name prefix through a sorted name list.
+    """
+    _store = None
+    _lock = threading.Lock()
+
+    def __init__(self, path=string.RESOURCE_DIR + 'phrase_split_data/melodies.pk'):
+        Logging.info("loading melodies, please wait for a few seconds...")
+        with open(path, 'rb') as file:
+            data = pickle.load(file)
+        Logging.info("melodies loaded.")
+        self.data = {'midi': data['midi'], 'pitch': data['melo'], 'number': data['roll']}
+        self._rows = {}
+        self.names = sorted(item[0] for item in self.data['pitch'])
+
+    @classmethod
+    def get_store(cls):
+        if cls._store is None:
+            with cls._lock:
+                if cls._store is None:
+                    cls._store = MelodyStore()
+        return cls._store
+
+    def row(self, name, output_form='pitch'):
+        """index of the first phrase called name in data[output_form], None if there is none"""
+        if output_form not in self._rows:
+            rows = {}
+            for i, item in enumerate(self.data[output_form]):
+                rows.setdefault(item[0], i)
+            self._rows[output_form] = rows
+        return self._rows[output_form].get(name)
+
+    def names_with_prefix(self, prefix):
+        """sorted, including repeated names"""
+        found = []
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix):
+                break
+            found.append(self.names[i])
+        return found
+
+
 class MIDILoader:
 
     def __init__(self, midi_dir=string.STATIC_DIR + 'midi/', files="*"):
@@ -414,6 +512,7 @@ class MIDILoader:
         self._config = {
             'output_form': 'pitch'
         }
+        self._store = None
         self.load_midis(files)
 
     def config(self, output_form='pitch'):
@@ -431,12 +530,10 @@ class MIDILoader:
 
     def load_midis(self, files):
         if files == 'POP909':
-            Logging.info("loading melodies, please wait for a few seconds...")
-            data = pickle.load(open(string.RESOURCE_DIR + 'phrase_split_data/melodies.pk', 'rb'))
-            Logging.info("melodies loaded.")
-            self.midis = data['midi']
-            self.transformed = data['melo']
-            self.roll = data['roll']
+            self._store = MelodyStore.get_store()
+            self.midis = self._store.data['midi']
+            self.transformed = self._store.data['pitch']
+            self.roll = self._store.data['number']
         else:
             try:
                 if files == '*':
@@ -564,6 +661,10 @@ class MIDILoader:
             return picked_midis
         elif type(name) is str:
             midis = self.__get_data()
+            if self._store is not None:
+                row = self._store.row(name, self._config['output_form'])
+                # a copy, the store is shared by every loader in the process
+                return list(midis[row][5]) if row is not None else None
             for i in range(len(midis)):
                 if midis[i][0] == name:
                     return midis[i][5]
@@ -585,12 +686,16 @@ class MIDILoader:
 
         # get tonic
         midis = self.__get_data()
-        for i in range(len(midis)):
-            if midis[i][0] == all_names[0]:
-                tonic = midis[i][1]
-                break
+        row = self._store.row(all_names[0], 'pitch') if self._store is not None and all_names else None
+        if row is not None:
+            tonic = midis[row][1]
         else:
-            raise Exception('???')
+            for i in range(len(midis)):
+                if midis[i][0] == all_names[0]:
+                    tonic = midis[i][1]
+                    break
+            else:
+                raise Exception('???')
 
         full_melo = []
         for name in all_names:
@@ -650,16 +755,13 @@ class MIDILoader:
     @staticmethod
     def auto_find_pop909_source_name(start_with=None):
         all_names = []
-        temp_loader = MIDILoader(files='POP909')
         if start_with:
             if type(start_with) is str:
                 start_with = [start_with]
             assert type(start_with) is list
+            store = MelodyStore.get_store()
             for this in start_with:
-                for item in temp_loader.transformed:
-                    if item[0][:len(this)] == this:
-                        all_names.append(item[0])
-        del temp_loader
+                all_names += store.names_with_prefix(this)
         return sorted(all_names)
 
 
@@ -0,0 +1,69 @@
+import itertools
+
+import pytest
+
+from chorderator.chords.ChordProgression import read_progressions
+from chorderator.chords.RootSequenceIndex import RootSequenceIndex, count_by_scan, transition_chord_sequences
+
+
+class Template:
+    """the part of ChordProgression the index reads"""
+
+    def __init__(self, roots):
+        self.roots = roots
+
+    def get(self, only_root=False, flattened=False):
+        return list(self.roots)
+
+
+@pytest.fixture(scope='module')
+def rep():
+    return read_progressions('rep')
+
+
+def test_rep_transitions_match_scan(rep):
+    index = RootSequenceIndex(rep)
+    assert len(index) == len(rep)
+    templates = list(rep)[:40]
+    for prev, cur in zip(templates, templates[1:]):
+        chord_sequences = transition_chord_sequences(prev, cur)
+        assert index.score(chord_sequences) == count_by_scan(rep, chord_sequences)
+        for chord_sequence in chord_sequences:
+            assert index.count(chord_sequence) == count_by_scan(rep, [chord_sequence])
+
+
+def test_rep_ngrams_match_scan(rep):
+    index = RootSequenceIndex(rep)
+    roots = [1, 2, 3, 4, 5, 6]
+    for n in [2, 3]:
+        for chord_sequence in itertools.product(roots, repeat=n):
+            assert index.count(list(chord_sequence)) == count_by_scan(rep, [list(chord_sequence)])
+
+
+TEMPLATES = [Template([1, 1, 4, 4, 5, 5, 1, 1]), Template([1, 4, 1, 4]), Template([6, 6, 6, 6]), Template([2, 5])]
+
+
+@pytest.mark.parametrize('chord_sequence', [
+    [1],  # a single chord is never counted
+    [6],
+    [1, 4, 5, 1, 4, 5, 1],  # longer than every template
+    [1, 4],  # twice in one template, counted once
+    [1, 4, 5],  # found after merging 1 1 4 4 5
+    [1, 1, 4],  # repeated roots in the sequence never match merged templates
+    [6, 6],
+    [5, 1],
+    [2, 5],
+    [5, 2],
+])
+def test_edge_cases_match_scan(chord_sequence):
+    index = RootSequenceIndex(TEMPLATES)
+    assert index.count(chord_sequence) == count_by_scan(TEMPLATES, [chord_sequence])
+
+
+def test_edge_case_counts():
+    index = RootSequenceIndex(TEMPLATES)
+    assert index.count([1]) == 0
+    assert index.count([1, 4, 5, 1, 4, 5, 1]) == 0
+    assert index.count([1, 4]) == 2
+    assert index.count([1, 1, 4]) == 0
+    assert index.score([[1, 4], [4, 5], [1]]) == count_by_scan(TEMPLATES, [[1, 4], [4, 5], [1]]) == 3